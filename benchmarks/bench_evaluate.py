@@ -0,0 +1,62 @@
+import tempfile
+from typing import Dict, List, Any
+from source.cfg import CFG
+from source.evaluate import evaluate
+from source.generate import generate_pairs
+from grammars.free_choice import fcp_base, populate
+from benchmarks.common import measure, synthetic_lexicon
+
+
+def build_tiny_model(directory: str, pairs: List[tuple[str, str]]) -> None:
+    """
+    Save a tiny randomly initialized sequence-classification model and its tokenizer to a directory,
+    so that it can be loaded by name like a HuggingFace checkpoint without any download.
+    """
+
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import BertConfig, BertForSequenceClassification, PreTrainedTokenizerFast
+
+    # Word-level vocabulary over the benchmark pairs
+    special_tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]"]
+    words = sorted({word for pair in pairs for sentence in pair for word in sentence.replace(".", " . ").split()})
+    vocab = {token: i for i, token in enumerate(special_tokens + words)}
+
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="[UNK]"))
+    backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    backend.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        pair="[CLS] $A [SEP] $B:1 [SEP]:1",
+        special_tokens=[("[CLS]", vocab["[CLS]"]), ("[SEP]", vocab["[SEP]"])],
+    )
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        pad_token="[PAD]", unk_token="[UNK]", cls_token="[CLS]", sep_token="[SEP]",
+    )
+
+    config = BertConfig(
+        vocab_size=len(vocab),
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        num_labels=3,
+        id2label={0: "CONTRADICTION", 1: "NEUTRAL", 2: "ENTAILMENT"},
+        label2id={"CONTRADICTION": 0, "NEUTRAL": 1, "ENTAILMENT": 2},
+    )
+
+    tokenizer.save_pretrained(directory)
+    BertForSequenceClassification(config).save_pretrained(directory)
+
+
+def run(num_pairs: int = 512, batch_size: int = 16, repeat: int = 3) -> List[Dict[str, Any]]:
+    """Measure pairs/sec of evaluate with a tiny local model on pairs sampled from a free-choice grammar."""
+
+    grammars = populate(fcp_base, synthetic_lexicon(100))
+    grammar = CFG(rules=grammars["PE_A_or_B_impl_PE_X"], axiom="S")
+    pairs = list(generate_pairs(grammar, num_pairs))
+
+    with tempfile.TemporaryDirectory() as directory:
+        build_tiny_model(directory, pairs)
+
+        return [measure("evaluate", lambda: evaluate(pairs, directory, batch_size), len(pairs), repeat, batch_size=batch_size)]
@@ -0,0 +1,66 @@
+from typing import Dict, List, Any
+from source.cfg import CFG
+from source.cfg_utils import Rule
+from source.generate import generate_examples
+from grammars.free_choice import fcp_base, populate
+from benchmarks.common import measure, synthetic_lexicon
+
+
+def run(sizes: List[int], num_examples: int = 200, repeat: int = 3) -> List[Dict[str, Any]]:
+    """
+    Measure examples/sec of CFG.generate and generate_examples (template and general engines) on each fcp_base sub-grammar,
+    and updates/sec of a grow-and-resample loop (add one lexical rule, then sample a few examples) with add_rules
+    and with a full rebuild, for each lexicon size.
+    """
+
+    records: List[Dict[str, Any]] = []
+
+    for size in sizes:
+        grammars = populate(fcp_base, synthetic_lexicon(size))
+
+        for name, rules in grammars.items():
+            grammar = CFG(rules=rules, axiom="S")
+
+            def sample_trees():
+                for _ in range(num_examples):
+                    grammar.generate()
+
+            records.append(measure("cfg.generate", sample_trees, num_examples, repeat, grammar=name, lexicon_size=size))
+            records.append(measure("generate_examples", lambda: generate_examples(grammar, num_examples), num_examples, repeat, grammar=name, lexicon_size=size))
+            records.append(measure("generate_examples.general", lambda: generate_examples(grammar, num_examples, use_templates=False), num_examples, repeat, grammar=name, lexicon_size=size))
+            records.extend(run_updates(name, rules, size, repeat=repeat))
+
+    return records
+
+
+def run_updates(name: str, rules: List[Rule], size: int, num_updates: int = 20, num_examples: int = 10, repeat: int = 3) -> List[Dict[str, Any]]:
+    """
+    Measure updates/sec of a grow-and-resample loop on a grammar: add one NP rule, then sample num_examples examples.
+    With add_rules, only the slots drawing from NP are patched in the template engine, so an update should cost
+    time proportional to the NP rules, not to the grammar; the rebuild measurement is the baseline.
+    """
+
+    records: List[Dict[str, Any]] = []
+    grammar = CFG(rules=list(rules), axiom="S")
+    grammar.template_engine()
+    added = [0]
+
+    def new_rule() -> Rule:
+        added[0] += 1
+        return Rule(left="NP", right=[f"the newcomer{added[0]}"], features={"subj": f"the newcomer{added[0]}"})
+
+    def grow_incremental():
+        for _ in range(num_updates):
+            grammar.add_rules([new_rule()])
+            generate_examples(grammar, num_examples)
+
+    def grow_rebuild():
+        current = list(rules)
+        for _ in range(num_updates):
+            current.append(new_rule())
+            generate_examples(CFG(rules=current, axiom="S"), num_examples)
+
+    records.append(measure("cfg.add_rules+sample", grow_incremental, num_updates, repeat, grammar=name, lexicon_size=size))
+    records.append(measure("cfg.rebuild+sample", grow_rebuild, num_updates, repeat, grammar=name, lexicon_size=size))
+
+    return records
@@ -0,0 +1,44 @@
+from typing import Dict, List, Any
+from source.cfg import CFG
+from source.cfg_utils import join, unify
+from grammars.free_choice import fcp_base, populate
+from benchmarks.common import measure, synthetic_lexicon
+
+
+def run(calls: int = 10000, repeat: int = 3) -> List[Dict[str, Any]]:
+    """Microbenchmarks for unify, Tree.output and join on typical free-choice inputs."""
+
+    records: List[Dict[str, Any]] = []
+
+    # Unification of a bound context against a lexical rule, compatible and conflicting
+    context = {'verb': 'verb1', 'ant': 'n'}
+    for case, rule_features in [("match", {'verb': 'verb1', 'ant': 'n'}), ("variable", {'verb': '?a', 'ant': 'n'}), ("conflict", {'verb': 'verb2', 'ant': 'n'})]:
+
+        def unify_calls():
+            for _ in range(calls):
+                unify(context, rule_features)
+
+        records.append(measure("unify", unify_calls, calls, repeat, case=case))
+
+    # A sampled tree and its yield from a representative grammar
+    grammars = populate(fcp_base, synthetic_lexicon(100))
+    grammar = CFG(rules=grammars["PE_A_or_B_impl_PE_X"], axiom="S")
+    tree = grammar.generate()
+    tokens = tree.output()
+
+    def output_calls():
+        for _ in range(calls):
+            tree.output()
+
+    def join_calls():
+        for _ in range(calls):
+            join(tokens)
+
+    def detokenizer_calls():
+        grammar.detokenizer.join_many([tokens] * calls)
+
+    records.append(measure("tree.output", output_calls, calls, repeat))
+    records.append(measure("join", join_calls, calls, repeat))
+    records.append(measure("detokenizer.join_many", detokenizer_calls, calls, repeat))
+
+    return records
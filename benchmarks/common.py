@@ -0,0 +1,53 @@
+import time
+from typing import Callable, Dict, List, Any
+from source.cfg_utils import Rule
+
+
+def measure(name: str, function: Callable[[], Any], operations: int, repeat: int = 3, **params) -> Dict[str, Any]:
+    """
+    Time a benchmark function and return its result record.
+    The best of `repeat` runs is kept, as it is the least disturbed by the rest of the system.
+
+    -   name (str): the benchmark name.
+    -   function (Callable): runs the benchmarked operations once.
+    -   operations (int): the number of operations (examples, pairs, calls) done by one run.
+    -   params: the benchmark parameters, stored in the record.
+    """
+
+    timings: List[float] = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+
+    return {
+        "name": name,
+        "params": params,
+        "operations": operations,
+        "seconds": best,
+        "ops_per_sec": operations / best if best > 0 else float("inf"),
+    }
+
+
+def synthetic_lexicon(size: int) -> Dict[str, List[Rule]]:
+    """
+    Build a synthetic lexicon with `size` items per lexical category of the free-choice grammars.
+    The verb forms are aligned by position, as expected by grammars.free_choice.populate.
+    """
+
+    verbs = [f"verb{i}" for i in range(size)]
+
+    forms = {
+        "NP": [f"the person{i}" for i in range(size)],
+        "V_INF": verbs,
+        "V_3SG": [f"{verb}s" for verb in verbs],
+        "V_INF_neg": verbs,
+        "V_INF_ant": [f"un{verb}" for verb in verbs],
+        "V_3SG_neg": [f"{verb}s" for verb in verbs],
+        "V_3SG_ant": [f"un{verb}s" for verb in verbs],
+    }
+
+    return {category: [Rule(left=category, right=[item]) for item in items] for category, items in forms.items()}
@@ -0,0 +1,63 @@
+import sys
+import json
+import argparse
+import platform
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from source.paths import PROJECT_ROOT
+from benchmarks import bench_generation, bench_micro
+
+
+def current_commit() -> str:
+    """Return the current git commit, so that results can be compared across commits."""
+
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PROJECT_ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Deontic NLI - benchmark suite")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 100, 1000], help="synthetic lexicon sizes (default: 10 100 1000)")
+    parser.add_argument("--examples", type=int, default=200, help="examples generated per measurement (default: 200)")
+    parser.add_argument("--calls", type=int, default=10000, help="calls per microbenchmark measurement (default: 10000)")
+    parser.add_argument("--pairs", type=int, default=512, help="pairs evaluated per measurement (default: 512)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one is kept (default: 3)")
+    parser.add_argument("--skip-evaluate", action="store_true", help="skip the evaluation benchmark (requires torch and transformers)")
+    parser.add_argument("-o", "--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    records = []
+
+    # Keep stdout for the JSON report: messages printed by the code under test go to stderr
+    with redirect_stdout(sys.stderr):
+        records.extend(bench_generation.run(args.sizes, args.examples, args.repeat))
+        records.extend(bench_micro.run(args.calls, args.repeat))
+
+        if not args.skip_evaluate:
+            from benchmarks import bench_evaluate
+            records.extend(bench_evaluate.run(args.pairs, repeat=args.repeat))
+
+    report = {
+        "commit": current_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": records,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+        print(f"Saved benchmark results to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,5 @@
-import os
-import json
-from copy import deepcopy
 from source.cfg_utils import Rule
+from source.lexicon import Lexicon, LexiconStore, store_path
 from source.generate import format_rules
 
 # ------------------------------------
@@ -363,77 +361,152 @@ fcp_base = {
 
 from collections import defaultdict
 
-# Load lexical item grammar rules
-rule_files = []
+# Verb categories, and the category of the form used as their "verb" feature
+VERB_HEADS = {
+    "V_INF": "V_INF",
+    "V_3SG": "V_INF",           # 3SG -> INF
+    "V_INF_neg": "V_INF_neg",
+    "V_INF_ant": "V_INF_neg",   # ant-INF -> neg-INF
+    "V_3SG_neg": "V_INF_neg",   # neg-3SG -> neg-INF
+    "V_3SG_ant": "V_INF_neg",   # ant-3SG -> neg-INF
+}
 
-# Group lexical rules by their left-hand category (e.g., "V_INF", "V_3SG", ...)
-lexical_rules = defaultdict(list)
+def link_forms(entries):
+    """
+    Map each verb form, as a (category, form) pair, to the form of the same entry used as its "verb" feature.
 
-# Add them to the grammar (merge rules from all files)
-for filename in rule_files:
-    rules_path = os.path.join(os.path.dirname(__file__), '..', 'data', 'rules', filename + '.json')
-    
-    with open(rules_path, 'r') as json_file:
-        data = json.load(json_file)
-        lexical_rules = format_rules(data)
-
-# Build lists of corresponding forms (take the first RHS token for each rule)
-v_inf_list      = [r.right[0] for r in lexical_rules.get("V_INF", [])]
-v_3sg_list      = [r.right[0] for r in lexical_rules.get("V_3SG", [])]
-v_inf_neg_list  = [r.right[0] for r in lexical_rules.get("V_INF_neg", [])]
-v_inf_ant_list  = [r.right[0] for r in lexical_rules.get("V_INF_ant", [])]
-v_3sg_neg_list  = [r.right[0] for r in lexical_rules.get("V_3SG_neg", [])]
-v_3sg_ant_list  = [r.right[0] for r in lexical_rules.get("V_3SG_ant", [])]
-
-# Create dictionaries for feature building
-verb_to_inf        = dict(zip(v_3sg_list,   v_inf_list))         # 3SG -> INF
-verb_to_ant_inf    = dict(zip(v_inf_ant_list,  v_inf_neg_list))  # ant-INF -> neg-INF
-verb_to_ant_3sg_1  = dict(zip(v_3sg_neg_list, v_inf_neg_list))   # neg-3SG -> neg-INF
-verb_to_ant_3sg_2  = dict(zip(v_3sg_ant_list, v_inf_neg_list))   # ant-3SG -> neg-INF
+    -   entries (List[Dict[str, str]]): the linked forms of each lexical entry (see LexiconStore.entries).
+    """
+
+    links = {}
+
+    for entry in entries:
+        for category, form in entry.items():
+            head = VERB_HEADS.get(category)
+            if head in entry:
+                links[(category, form)] = entry[head]
+
+    return links
+
+def align_forms(lexical_rules):
+    """
+    Map each verb form to its "verb" feature for lexical rules without links (like link_forms),
+    assuming that the rules of the verb categories are aligned by position (e.g., the i-th V_3SG and the i-th V_INF).
+
+    -   lexical_rules (Dict[str, List[Rule]]): the lexical rules grouped by category.
+    """
+
+    # Build lists of corresponding forms (take the first RHS token for each rule)
+    forms = {category: [r.right[0] for r in lexical_rules.get(category, [])] for category in VERB_HEADS}
+
+    links = {}
+
+    for category, head in VERB_HEADS.items():
+        for form, head_form in zip(forms[category], forms[head]):
+            links[(category, form)] = head_form
+
+    return links
+
+def build_lexicon(lexical_rules, links=None):
+    """
+    Build the lexicon shared by all the sub-grammars: the lexical rules,
+    with the agreement features linking the verb forms.
+
+    -   lexical_rules (Dict[str, List[Rule]]): the lexical rules grouped by category (e.g., "V_INF", "V_3SG", ...).
+    -   links (Optional[Dict]): the "verb" feature of each (category, form) verb form, e.g. from link_forms on the entries
+        of a LexiconStore; by default, the verb forms are aligned by position (see align_forms).
+    """
+
+    if links is None:
+        links = align_forms(lexical_rules)
+
+    # Add relevant features (to copies: the input rules are left untouched)
+    categories = {}
+
+    for category, rules_list in lexical_rules.items():
+        categories[category] = []
+
+        for rule in rules_list:
+            rule = Rule(rule.left, list(rule.right), rule.prob, dict(rule.features))
+
+            if rule.left == "NP":
+                rule.features.setdefault("subj", rule.right[0])
+            
+            if rule.left in VERB_HEADS:
+                rule.features.setdefault("verb", links.get((rule.left, rule.right[0]), rule.right[0]))
+
+            if rule.left in ("V_INF_neg", "V_3SG_neg"):
+                rule.features.setdefault("ant", "n")
+            if rule.left in ("V_INF_ant", "V_3SG_ant"):
+                rule.features.setdefault("ant", "y")
+
+            categories[category].append(rule)
+
+    return Lexicon(categories)
+
+
+def populate(grammars_base, lexical_rules):
+    """
+    Populate each base grammar with the lexical rules of the categories it uses.
+    The rules are not copied: all the sub-grammars reference the structural rules of their base
+    and the rules of a single shared Lexicon, so adding a sub-grammar only costs its structural rules.
+
+    -   grammars_base (Dict[str, List[Rule]]): the structural rules of each sub-grammar.
+    -   lexical_rules (Lexicon | Dict[str, List[Rule]]): the shared lexicon, or the lexical rules grouped by category.
+    """
+
+    lexicon = lexical_rules if isinstance(lexical_rules, Lexicon) else build_lexicon(lexical_rules)
+
+    # Store populated grammars (will be used to generate examples)
+    populated = {}
+
+    for name, grammar in grammars_base.items():
+
+        # Lexical categories used by the grammar, in order of first use
+        categories = {}
+        for rule in grammar:
+            for category in lexicon:
+                if category in rule.right:
+                    categories[category] = None
+
+        # Add lexical rules, unless the base already has them
+        base_rules = set(grammar)
+        populated[name] = list(grammar) + [rule for rule in lexicon.rules(categories) if rule not in base_rules]
+
+    return populated
 
 # ----------------------------------------
 # Populate the grammars with lexical rules
 # ----------------------------------------
 
-# Store populated grammars (will be used to generate examples)
-fcp = {}
+# Load lexical item grammar rules from lexicon stores (see --generate-rules --save), e.g. "lexicon" for data/rules/lexicon.db
+rule_stores = []
 
-for name, grammar in fcp_base.items():
-    fcp[name] = deepcopy(grammar)
+# Grammar category of the stored categories named after prompt labels (see prompts.json)
+STORE_CATEGORIES = {
+    "N": "NP",
+    "Verb": "V_INF_neg",        # verb of a verb/antonym pair
+    "Antonym": "V_INF_ant",     # its antonym (ant-INF -> neg-INF)
+}
 
-    # Add lexical rules: if grammar has a placeholder symbol that matches keys in lexical_rules,
-    # extend the grammar with those lexical rules.
-    new_rules = set()
-    
-    for rule in grammar:
-        for category, rules_list in lexical_rules.items():
-            if category in rule.right:
-                new_rules.update(rules_list)
-
-    for rule in new_rules:
-        if rule not in fcp[name]:
-            fcp[name].append(rule)
-
-    # Add relevant features
-    for rule in fcp[name]:
-        if rule.left == "NP":
-            rule.features.setdefault("subj", rule.right[0])
-        
-        if rule.left == "V_INF":
-            rule.features.setdefault("verb", rule.right[0])
-        if rule.left == "V_3SG":
-            rule.features.setdefault("verb", verb_to_inf.get(rule.right[0], rule.right[0]))
-        
-        if rule.left == "V_INF_neg":
-            rule.features.setdefault("verb", rule.right[0])
-            rule.features.setdefault("ant", "n")
-        if rule.left == "V_INF_ant":
-            rule.features.setdefault("verb", verb_to_ant_inf.get(rule.right[0], rule.right[0]))
-            rule.features.setdefault("ant", "y")
-        
-        if rule.left == "V_3SG_neg":
-            rule.features.setdefault("verb", verb_to_ant_3sg_1.get(rule.right[0], rule.right[0]))
-            rule.features.setdefault("ant", "n")
-        if rule.left == "V_3SG_ant":
-            rule.features.setdefault("verb", verb_to_ant_3sg_2.get(rule.right[0], rule.right[0]))
-            rule.features.setdefault("ant", "y")
+# Group lexical rules by their left-hand category (e.g., "V_INF", "V_3SG", ...)
+lexical_rules = defaultdict(list)
+
+# Verb forms linked by the entries of the stores
+verb_links = {}
+
+# Add them to the grammar (merge rules from all stores, which must exist: they are opened read-only)
+for filename in rule_stores:
+    store = LexiconStore(store_path(filename), readonly=True)
+
+    items = {STORE_CATEGORIES.get(category, category): forms for category, forms in store.items().items()}
+    for category, rules_list in format_rules(items).items():
+        lexical_rules[category].extend(rules_list)
+
+    entries = [{STORE_CATEGORIES.get(category, category): form for category, form in entry.items()} for entry in store.entries()]
+    verb_links.update(link_forms(entries))
+
+    store.close()
+
+fcp_lexicon = build_lexicon(lexical_rules, verb_links)
+fcp = populate(fcp_base, fcp_lexicon)
@@ -1,4 +1,5 @@
 import json
+import sqlite3
 import logging
 import argparse
 from tqdm import tqdm
@@ -9,8 +10,10 @@ from argparse import RawTextHelpFormatter
 # Import CFG and generation source code
 from source.paths import *
 from source.cfg import CFG
-from source.generate import generate_examples, generate_items, format_examples
-from source.evaluate import evaluate, write_to_file, compute_entropies, plot_mustache
+from source.cache import ResponseCache
+from source.lexicon import LexiconStore, store_path
+from source.profiling import start_profiling
+from source.generate import generate_pairs, generate_lexicon
 
 # Grammars
 from grammars.axiom_obrm import obrm, obrm_base
@@ -39,6 +42,85 @@ GRAMMARS = {
 # Current models to generate text
 MODELS_GEN = ["gpt-oss", "mistral", "deepseek-r1", "llama3.1"]
 
+# -------
+# HELPERS
+# -------
+
+def save_evaluations(evaluations, model_names, total, eval_mode="entropy", no_plots=False):
+    """
+    Write the results of a stream of (model_name, key, results, classes) evaluations under results/
+    (one sub-directory per model when there are several), then the per-model comparison and the plots.
+    """
+
+    from source.evaluate import write_to_file, save_entropies, summarize, write_comparison
+
+    # With several models, the results of each one go to their own sub-directory
+    model_dirs = {}
+    for model_name in model_names:
+        model_dirs[model_name] = RESULTS_DIR if len(model_names) == 1 else RESULTS_DIR / model_name.replace("/", "__")
+        model_dirs[model_name].mkdir(parents=True, exist_ok=True)
+
+    all_entropies = {model_name: {} for model_name in model_names}
+    all_probs = {model_name: {} for model_name in model_names}
+    all_classes = {}
+    comparison = []
+
+    for model_name, key, res, cls in tqdm(evaluations, total=total, desc=f"Evaluating grammars"):
+        comparison.append({"model": model_name, "grammar": key, **summarize(res)})
+        all_classes[model_name] = cls
+
+        if eval_mode == "detailed":
+            write_to_file(res, cls, key, model_dirs[model_name])
+            all_probs[model_name][key] = res.probs
+        else:
+            all_entropies[model_name][key] = res.entropies()
+
+    if eval_mode == "entropy":
+        for model_name, out_dir in model_dirs.items():
+            save_entropies(all_entropies[model_name], out_dir)
+
+    if len(model_names) > 1:
+        write_comparison(comparison, RESULTS_DIR)
+
+    # Plotting (and importing matplotlib) only happens once every grammar key is evaluated
+    if not no_plots:
+        from source.plot import plot_all, plot_mustache
+
+        for model_name, out_dir in model_dirs.items():
+            if eval_mode == "detailed" and all_probs[model_name]:
+                plot_all(all_probs[model_name], all_classes[model_name], out_dir)
+
+            if eval_mode == "entropy":
+                plot_mustache(all_entropies[model_name], out_dir)
+
+def load_examples(path):
+    """
+    Load the premise/hypothesis pairs of each grammar from a JSON file ({grammar: [[premise, hypothesis], ...]})
+    or from the JSON lines written by --stream --tee ({"grammar": ..., "premise": ..., "hypothesis": ...} per line).
+    """
+
+    with open(path, "r", encoding="utf-8") as f:
+        if Path(path).suffix != ".jsonl":
+            return {key: [tuple(item) for item in tuples] for key, tuples in json.load(f).items()}
+
+        examples = {}
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                examples.setdefault(record["grammar"], []).append((record["premise"], record["hypothesis"]))
+
+        return examples
+
+def print_coverage(grammars):
+    """Print how many rules of each grammar were used by coverage-targeted sampling."""
+
+    for name, grammar in grammars.items():
+        coverage = grammar.coverage.to_dict(grammar)
+        print(f"\nCoverage of {name}: {coverage['used_rules']}/{coverage['rules']} rules used (least used: {coverage['least_uses']} time(s))")
+        for rule in coverage["unused"]:
+            print(f"   - unused: {rule}")
+
+
 # ----------------
 # PARSER ARGUMENTS
 # ----------------
@@ -82,15 +164,16 @@ def main():
         )
     )
 
-    # Select an evaluation models
+    # Select one or several evaluation models
     parser.add_argument(
         "--nli-model",
         metavar="MODEL_NAME",
         type=str,
-        default="FacebookAI/roberta-large-mnli",
+        nargs="+",
+        default=["FacebookAI/roberta-large-mnli"],
         help=(
-            "HuggingFace model name to use for NLI evaluation; "
-            "(default: FacebookAI/roberta-large-mnli)"
+            "HuggingFace model name(s) to use for NLI evaluation; several models are evaluated one after the other "
+            "and compared in results/comparison.csv (default: FacebookAI/roberta-large-mnli)"
         )
     )
 
@@ -116,11 +199,64 @@ def main():
         help="generate N lexical items and format them into CFG rules using an LLM (default: 100)"
     )
 
+    # Convert a former JSON rule file into a lexicon store
+    parser.add_argument(
+        "--import-rules",
+        metavar="JSON_FILE",
+        help="import a JSON rule file from data/rules/ into the lexicon store given with --save"
+    )
+
+    # Number of simultaneous requests sent to the ollama server
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        metavar="N",
+        help="maximum number of concurrent lexical generation requests (default: 4)"
+    )
+
+    # Maximum number of items asked in a single request
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=50,
+        metavar="N",
+        help="split lexical generation into requests of at most N items (default: 50)"
+    )
+
+    # Seed for generation requests
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        metavar="SEED",
+        help=(
+            "sampling seed sent with lexical generation requests; with --generate-examples, "
+            "example i is sampled from a generator keyed by (SEED, grammar, i) (default: none)"
+        )
+    )
+
+    # First example index for counter-based example generation
+    parser.add_argument(
+        "--start",
+        type=int,
+        default=0,
+        metavar="INDEX",
+        help="with --seed, generate examples START to START+N-1, e.g. to shard a dataset across machines (default: 0)"
+    )
+
+    # Disable the response cache for lexical generation
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always query the LLM, ignoring and not filling the lexical generation cache"
+    )
+
     # Save generated rules/examples toggle
     parser.add_argument(
         "-s", "--save",
         metavar="FILENAME",
-        help="save generated rules/examples under data/<FILENAME>"
+        help="save generated examples under data/examples/<FILENAME>, or lexical items in the lexicon store data/rules/<FILENAME>(.db)"
     )
 
     # Evaluate NLI on a JSON file of pairs
@@ -128,7 +264,7 @@ def main():
         "-e", "--evaluate",
         metavar="FILENAME",
         type=Path,
-        help="evaluate a JSON file with examples"
+        help="evaluate a JSON file with examples, or the JSON lines (.jsonl) written by --tee"
     )
 
     parser.add_argument(
@@ -138,32 +274,237 @@ def main():
         help="choose evaluation mode: 'entropy' for entropy boxplot only, 'detailed' for per-grammar detailed plots (default: entropy)"
     )
 
+    # Inference backend for NLI evaluation
+    parser.add_argument(
+        "--nli-backend",
+        choices=["torch", "onnx"],
+        default="torch",
+        help="run NLI models with PyTorch, or export them once to ONNX (cached under results/onnx/) and run them with onnxruntime on CPU (default: torch)"
+    )
+
+    # Cheap first-pass model for adaptive evaluation
+    parser.add_argument(
+        "--cascade",
+        metavar="CHEAP_MODEL",
+        help=(
+            "score all pairs with a cheap model first (HuggingFace name, or layers:N for the NLI model truncated to N layers) "
+            "and only send pairs above --cascade-threshold to the NLI model"
+        )
+    )
+
+    parser.add_argument(
+        "--cascade-threshold",
+        type=float,
+        default=0.5,
+        metavar="BITS",
+        help="entropy (bits) above which a pair is sent to the full NLI model (default: 0.5)"
+    )
+
+    parser.add_argument(
+        "--cascade-audit",
+        action="store_true",
+        help="also run the full NLI model on confident pairs to report the agreement of the cascade"
+    )
+
+    # Fused generation and evaluation
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="with --generate-examples, evaluate the pairs with --nli-model while they are being generated, without intermediate files"
+    )
+
+    parser.add_argument(
+        "--tee",
+        metavar="FILENAME",
+        help="with --stream, also write the generated pairs as JSON lines under data/examples/<FILENAME> (readable by --evaluate as .jsonl)"
+    )
+
+    # Skip plotting during evaluation
+    parser.add_argument(
+        "--no-plots",
+        action="store_true",
+        help="only write the evaluation results, without rendering plots (they can be rendered later with --plot)"
+    )
+
+    # Render plots from persisted results
+    parser.add_argument(
+        "--plot",
+        action="store_true",
+        help="render the plots from the results persisted in results/ by a previous evaluation"
+    )
+
+    # Remove dead rules before sampling
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="statically analyze the selected grammars, report and remove unreachable, unproductive and unsatisfiable rules"
+    )
+
+    # Restart derivations reaching a dead end
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=10,
+        metavar="N",
+        help="restart an example at most N times when its derivation reaches a dead end (default: 10)"
+    )
+
+    # Balance rule usage across examples instead of sampling them independently
+    parser.add_argument(
+        "--coverage",
+        nargs="?",
+        type=int,
+        const=0,
+        default=None,
+        metavar="M",
+        help="pick the least used candidate rules first, to cover every rule with few examples; with M, only until each candidate is used M times"
+    )
+
+    # Export rule selection statistics after generation
+    parser.add_argument(
+        "--generation-stats",
+        metavar="FILENAME",
+        help="collect candidate, unification and rule usage statistics during generation and save them under results/<FILENAME>"
+    )
+
+    # Keep the NLI model resident and serve judgements over HTTP
+    parser.add_argument(
+        "--serve",
+        nargs="?",
+        const="127.0.0.1:8000",
+        default=None,
+        metavar="ADDRESS",
+        help="serve NLI judgements of --nli-model on HOST:PORT or unix:PATH (default: 127.0.0.1:8000)"
+    )
+
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=32,
+        metavar="N",
+        help="largest micro-batch of pairs in serve mode (default: 32)"
+    )
+
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=10.0,
+        metavar="MS",
+        help="latency budget for filling a micro-batch in serve mode (default: 10)"
+    )
+
+    # Per-stage timing report
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="STATS_FILE",
+        help="print a per-stage timing breakdown at exit; if STATS_FILE is given, also dump cProfile stats there"
+    )
+
     args = parser.parse_args()
 
+    if args.start and args.seed is None:
+        parser.error("--start requires --seed")
+
+    if args.stream and not args.generate_examples:
+        parser.error("--stream requires --generate-examples")
+
+    if args.tee and not args.stream:
+        parser.error("--tee requires --stream")
+
+    if args.tee and Path(args.tee).suffix != ".jsonl":
+        parser.error("--tee writes JSON lines: FILENAME must end with .jsonl")
+
+    if args.generation_stats and (args.stream or not args.generate_examples):
+        parser.error("--generation-stats requires --generate-examples, without --stream")
+
+    if args.profile is not None:
+        start_profiling(args.profile or None)
+
+    # Lexicon stores are SQLite databases: check the target before any generation
+    store = None
+    if args.import_rules or (args.generate_rules and args.save):
+        if not args.save:
+            parser.error("--import-rules requires --save")
+        if Path(args.save).suffix == ".json":
+            parser.error(f"--save {args.save}: lexical items are saved to a lexicon store (e.g. lexicon.db), import JSON rule files with --import-rules")
+        try:
+            store = LexiconStore(store_path(args.save))
+        except sqlite3.DatabaseError:
+            parser.error(f"--save {args.save}: {store_path(args.save)} is not a lexicon store")
+
+# -------
+# SERVING
+# -------
+
+    if args.serve:
+        from source.server import serve
+        serve(args.nli_model[0], args.serve, args.nli_backend, args.max_batch, args.max_wait_ms)
+
+        return
+
+# --------
+# PLOTTING
+# --------
+
+    if args.plot:
+        from source.plot import plot_results
+        plot_results(RESULTS_DIR)
+
+        return
+
+# ------------
+# IMPORT RULES
+# ------------
+
+    if args.import_rules:
+        with open(PROMPTS_PATH, "r", encoding="utf-8") as f:
+            prompts = json.load(f)
+
+        added = store.import_json(RULES_DIR / args.import_rules, prompts)
+        print(f"Imported {added} new entries from {RULES_DIR / args.import_rules} into {store.path} ({len(store)} entries)")
+        store.close()
+
+        return
+
 # ----------
 # EVALUATION
 # ----------
 
     if args.evaluate:
-        # Load examples
-        path = EXAMPLES_DIR / args.evaluate
-        with open(path, "r", encoding="utf-8") as f:
-            examples = json.load(f)
-        
-        all_entropies = {}
-
-        for key, tuples in tqdm(examples.items(), desc=f"Evaluating grammars"):
-            pairs = [tuple(item) for item in tuples]
-
-            if args.eval_mode == "detailed":
-                res, cls = evaluate(pairs, args.nli_model)
-                write_to_file(res, cls, key, RESULTS_DIR)
-            else:
-                entropies = compute_entropies(pairs, args.nli_model)
-                all_entropies[key] = entropies
-
-        if args.eval_mode == "entropy":
-            plot_mustache(all_entropies, RESULTS_DIR)
+        # Load and parse the pairs once for all models
+        examples = load_examples(EXAMPLES_DIR / args.evaluate)
+
+        # Models are only imported when needed (plotting workers re-import this module)
+        from source.evaluate import evaluate_models, cascade_models
+        evaluations = evaluate_models(examples, args.nli_model, backend=args.nli_backend)
+
+        # Adaptive evaluation: the cheap model's confident predictions are kept
+        cascade_reports = {}
+        if args.cascade:
+            if len(args.nli_model) > 1:
+                parser.error("--cascade works with a single --nli-model")
+
+            def cascaded():
+                cascade = cascade_models(examples, args.cascade, args.nli_model[0], args.cascade_threshold, audit=args.cascade_audit, backend=args.nli_backend)
+                for key, res, cls, report in cascade:
+                    cascade_reports[key] = report
+                    yield args.nli_model[0], key, res, cls
+
+            evaluations = cascaded()
+
+        save_evaluations(evaluations, args.nli_model, len(args.nli_model) * len(examples), args.eval_mode, args.no_plots)
+
+        if cascade_reports:
+            report_path = RESULTS_DIR / "cascade_report.json"
+            escalated = sum(report["escalated"] for report in cascade_reports.values())
+            total = sum(report["pairs"] for report in cascade_reports.values())
+            print(f"Cascade: {escalated}/{total} pairs sent to {args.nli_model[0]} ({1 - escalated / max(total, 1):.1%} saved)")
+            with open(report_path, "w", encoding="utf-8") as f:
+                json.dump(cascade_reports, f, indent=4)
+            print(f"Saving cascade report to {report_path}")
 
         return
 
@@ -242,7 +583,20 @@ def main():
             for idx in selected_indices:
                 selected_key = available_grammars[idx]
                 selected_grammar = grammars[selected_key]
-                selected_grammars[selected_key] = CFG(rules=selected_grammar, axiom="S")
+                selected_grammars[selected_key] = CFG(rules=selected_grammar, axiom="S", name=selected_key)
+
+            # Remove the rules that can never be applied
+            if args.prune:
+                for name, grammar in selected_grammars.items():
+                    analysis = grammar.analyze()
+                    print(f"\n----Static analysis of {name}----\n")
+                    print(analysis)
+                    selected_grammars[name] = grammar.prune(analysis)
+
+            # Coverage-targeted sampling (0 means always balanced)
+            if args.coverage is not None:
+                for grammar in selected_grammars.values():
+                    grammar.enable_coverage(args.coverage or None)
 
             # ---------------------
             # VIEW SELECTED GRAMMAR
@@ -257,7 +611,7 @@ def main():
                 if args.show == "base":
                     for name in selected_grammars:
                         base_rules = grammars_base[name]
-                        base_grammar = CFG(rules=base_rules, axiom="S")
+                        base_grammar = CFG(rules=base_rules, axiom="S", name=name)
                         print(f"\n----Context-free grammar for {name}----\n")
                         print(base_grammar)
 
@@ -265,19 +619,59 @@ def main():
 # GENERATE EXAMPLES
 # -----------------
 
+    # Fused pipeline: pairs go straight from the grammars to the NLI model
+    if args.generate_examples and args.stream:
+        if len(args.nli_model) > 1:
+            parser.error("--stream works with a single --nli-model")
+
+        from source.pipeline import stream_evaluate
+        model_name = args.nli_model[0]
+        tee_path = EXAMPLES_DIR / args.tee if args.tee else None
+
+        streamed = stream_evaluate(
+            selected_grammars,
+            model_name,
+            args.generate_examples,
+            backend=args.nli_backend,
+            start=args.start,
+            seed=args.seed,
+            max_retries=args.max_retries,
+            tee_path=tee_path
+        )
+        evaluations = ((model_name, key, res, cls) for key, res, cls in streamed)
+        save_evaluations(evaluations, args.nli_model, len(selected_grammars), args.eval_mode, args.no_plots)
+
+        if tee_path is not None:
+            print(f"\nSaved generated pairs to {tee_path}")
+
+        if args.coverage is not None:
+            print_coverage(selected_grammars)
+
+        return
+
     if args.generate_examples:
         examples_dict = {}
         
         for name, grammar in selected_grammars.items():
-            examples = generate_examples(grammar, args.generate_examples, print_tree=False)
-            examples_dict[name] = examples
+            if args.generation_stats:
+                grammar.enable_stats()
+            examples = generate_pairs(grammar, args.generate_examples, start=args.start, seed=args.seed, max_retries=args.max_retries)
+            examples_dict[name] = list(examples)
+
+        if args.generation_stats:
+            stats_path = RESULTS_DIR / args.generation_stats
+            RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+            with open(stats_path, "w", encoding="utf-8") as f:
+                json.dump({name: grammar.stats.to_dict(grammar) for name, grammar in selected_grammars.items()}, f, ensure_ascii=False, indent=4)
+            print(f"\nSaved generation statistics to {stats_path}")
+
+        if args.coverage is not None:
+            print_coverage(selected_grammars)
         
-        formatted_examples = format_examples(examples_dict)
-
         for name, examples_list in examples_dict.items():
             print(f"\n----Generated examples for {name}----\n")
-            for example in examples_list:
-                print(example)
+            for premise, hypothesis in examples_list:
+                print(f"[P] {premise} [H] {hypothesis}")
         
         if args.save:
             save_path = EXAMPLES_DIR / args.save
@@ -290,7 +684,7 @@ def main():
                 data = {}
             
             # Merge new examples into existing data
-            for name, examples_list in formatted_examples.items():
+            for name, examples_list in examples_dict.items():
                 if name in data and isinstance(data[name], list):
                     data[name].extend(examples_list)
                 else:
@@ -367,15 +761,17 @@ def main():
         # Get the labels
         keys_list = list(prompts.keys())
         selected_labels = [keys_list[idx] for idx in selected_indices]
-        output_dict = {}
 
         print("Generating items...")
-        for label in selected_labels:
-            prompt = "\n".join(prompts[label]["prompt"])
-            field_names = prompts[label]["labels"]
-            prompt = prompt.format(k=args.generate_rules)
-            result = generate_items(prompt, args.generate_rules, field_names, args.ollama_model)
-            output_dict.update(result)
+        output_dict = generate_lexicon(
+            {label: prompts[label] for label in selected_labels},
+            args.generate_rules,
+            args.ollama_model,
+            concurrency=args.concurrency,
+            chunk_size=args.chunk_size,
+            seed=args.seed,
+            cache=None if args.no_cache else ResponseCache(CACHE_DIR),
+        )
 
         for label, output in output_dict.items():
             print(f"\n--- {label} ---\n")
@@ -383,27 +779,18 @@ def main():
             for item in output:
                 print(item)
 
-        if args.save:
-            save_path = RULES_DIR / args.save
-
-            # Load existing data if the file exists
-            if save_path.exists():
-                with open(save_path, "r", encoding="utf-8") as f:
-                    lexical_items = json.load(f)
-            else:
-                lexical_items = {}
-
-            # Merge new lexical items into existing data
-            for name, examples_list in output_dict.items():
-                if name in lexical_items and isinstance(lexical_items[name], list):
-                    lexical_items[name].extend(examples_list)
-                else:
-                    lexical_items[name] = examples_list
-            
-            with open(save_path, "w", encoding="utf-8") as f:
-                json.dump(lexical_items, f, ensure_ascii=False, indent=4)
-            
-            print(f"\nSaved generated rules to {save_path}")
+        if store is not None:
+            # Append the new entries to the lexicon store, each with its linked forms (duplicates are skipped)
+            for label in selected_labels:
+                fields = {name: output_dict[name] for name in prompts[label]["labels"]}
+                linked = prompts[label].get("linked", False)
+                sizes = [len(items) for items in fields.values()]
+                generated = min(sizes) if linked else sum(sizes)
+                added = store.add(label, fields, linked)
+                print(f"\n{label}: {added} new entries ({generated - added} already in the store)")
+
+            print(f"\nSaved generated rules to {store.path} ({len(store)} entries)")
+            store.close()
 
 # Run CLI
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Any, Optional
+
+
+class ResponseCache:
+    """Class for the on-disk cache of validated lexical generation outputs."""
+
+    def __init__(self, directory: Path) -> None:
+        """
+        Initialize the cache in a directory (created on first write).
+
+        -   directory (Path): the directory where each cached response is stored as a JSON file.
+        """
+
+        self.directory: Path = Path(directory)
+
+    def key(self, model: str, messages: List[Dict[str, str]], schema: Dict[str, Any], seed: Optional[int] = None, ordinal: int = 0) -> str:
+        """
+        Compute the cache key of a request.
+        The ordinal distinguishes the successive chunks requested with the same prompt,
+        which would otherwise share a key and return the same items.
+        """
+
+        schema_hash = hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+        system_prompt = "\n".join(m["content"] for m in messages if m["role"] == "system")
+        user_prompt = "\n".join(m["content"] for m in messages if m["role"] == "user")
+
+        payload = json.dumps([model, system_prompt, user_prompt, schema_hash, seed, ordinal], ensure_ascii=False)
+
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, List[str]]]:
+        """Return the cached items for a key, or None on a miss."""
+
+        path = self.directory / f"{key}.json"
+        if not path.exists():
+            return None
+
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def put(self, key: str, items: Dict[str, List[str]]) -> None:
+        """Store validated items under a key."""
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so an interrupted run never leaves a truncated entry
+        path = self.directory / f"{key}.json"
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False)
+        tmp_path.replace(path)
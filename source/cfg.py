@@ -1,55 +1,591 @@
 import random
-from collections import defaultdict
-from typing import Set, List, Dict, DefaultDict, Any, Optional
-from source.cfg_utils import Rule, Tree, unify
+import hashlib
+import threading
+from collections import defaultdict, Counter
+from typing import Set, List, Dict, DefaultDict, Any, Optional, Sequence, Iterable
+from source.cfg_utils import Rule, Tree, Detokenizer, DeadEndError, unify
+from source.templates import TemplateGrammar, flatten
+from source.profiling import profiler
+
+
+class GenerationStats:
+    """Class to collect rule selection statistics over a batch of derivations."""
+
+    def __init__(self) -> None:
+        """
+        Initialize empty counters.
+
+        -   expansions (Counter): number of expansions of each non-terminal.
+        -   candidates (Counter): total number of candidate rules left after unification, per non-terminal.
+        -   unify_calls (Counter): number of unification attempts, per non-terminal.
+        -   unify_failures (Counter): number of failed unifications, per non-terminal.
+        -   dead_ends (Counter): number of expansions without any applicable rule, per non-terminal.
+        -   selections (Counter): number of times each rule (by rule ID) was selected.
+        """
+
+        self.expansions: Counter = Counter()
+        self.candidates: Counter = Counter()
+        self.unify_calls: Counter = Counter()
+        self.unify_failures: Counter = Counter()
+        self.dead_ends: Counter = Counter()
+        self.selections: Counter = Counter()
+
+        # Derivations may run concurrently on the same grammar
+        self.lock = threading.Lock()
+
+    def to_dict(self, grammar: "CFG") -> Dict[str, Any]:
+        """Export the statistics as a JSON-serializable dict, with rules rendered as strings."""
+
+        non_terminals = {}
+        for non_terminal in sorted(self.expansions):
+            expansions = self.expansions[non_terminal]
+            non_terminals[non_terminal] = {
+                "expansions": expansions,
+                "mean_candidates": self.candidates[non_terminal] / expansions,
+                "unify_calls": self.unify_calls[non_terminal],
+                "unify_failures": self.unify_failures[non_terminal],
+                "dead_ends": self.dead_ends[non_terminal],
+            }
+
+        rules = [
+            {"rule": grammar.rule_string(rule_id), "selections": count}
+            for rule_id, count in self.selections.most_common()
+        ]
+
+        return {
+            "unify_calls": sum(self.unify_calls.values()),
+            "unify_failures": sum(self.unify_failures.values()),
+            "dead_ends": sum(self.dead_ends.values()),
+            "non_terminals": non_terminals,
+            "rules": rules,
+        }
+
+
+class CoverageQuotas:
+    """
+    Class for coverage-targeted sampling over a batch of derivations.
+    Instead of sampling rules independently in each derivation (which needs many examples before every
+    lexical item and every structural alternative has been seen), each choice favors the candidate rules
+    used the least so far, so that rules are covered evenly with few examples.
+    """
+
+    def __init__(self, min_uses: Optional[int] = None) -> None:
+        """
+        Initialize empty usage counters.
+
+        -   min_uses (Optional[int]): if given, the least used candidates are only favored until every candidate
+            of a choice was used min_uses times, after which rules are sampled according to their probabilities
+            again; if None, choices are always balanced.
+        -   uses (Counter): number of times each rule (by rule ID) was selected.
+        """
+
+        self.min_uses: Optional[int] = min_uses
+        self.uses: Counter = Counter()
+
+        # Derivations may run concurrently on the same grammar
+        self.lock = threading.Lock()
+
+    def select(self, rng: Any, rule_ids: List[int], weights: List[float]) -> int:
+        """
+        Select one of the candidate rules of a choice and count its use. Returns its index in rule_ids.
+        Ties between the least used candidates are broken by sampling according to the rule probabilities.
+
+        -   rng (random.Random): the random generator of the derivation.
+        -   rule_ids (List[int]): the rule IDs of the candidate rules.
+        -   weights (List[float]): the normalized probabilities of the candidate rules.
+        """
+
+        with self.lock:
+            uses = [self.uses[rule_id] for rule_id in rule_ids]
+            least = min(uses)
+
+            # Quota not reached: pick among the least used candidates
+            if self.min_uses is None or least < self.min_uses:
+                pool = [index for index, count in enumerate(uses) if count == least]
+                selected = rng.choices(pool, weights=[weights[index] for index in pool], k=1)[0]
+            else:
+                selected = rng.choices(range(len(rule_ids)), weights=weights, k=1)[0]
+
+            self.uses[rule_ids[selected]] += 1
+
+        return selected
+
+    def to_dict(self, grammar: "CFG") -> Dict[str, Any]:
+        """Export the coverage as a JSON-serializable dict, with rules rendered as strings."""
+
+        unused = [rule_id for rule_id in range(len(grammar.rules)) if not self.uses[rule_id]]
+
+        return {
+            "rules": len(grammar.rules),
+            "used_rules": len(grammar.rules) - len(unused),
+            "least_uses": min((self.uses[rule_id] for rule_id in range(len(grammar.rules))), default=0),
+            "unused": [grammar.rule_string(rule_id) for rule_id in unused],
+        }
+
+
+class DerivationState:
+    """Class for the state of a single derivation, kept out of the grammar so that a CFG is never mutated by generation."""
+
+    def __init__(self, rng: Optional[random.Random] = None) -> None:
+        """
+        Initialize an empty derivation state.
+
+        -   feature_bindings (Dict): the variable bindings recorded for each non-terminal during the derivation.
+        -   rng (random.Random): the random generator used to sample rules (the global random module by default).
+        """
+
+        self.feature_bindings: Dict[str, Dict[str, Any]] = {}
+        self.rng: Any = rng if rng is not None else random
+
+
+def example_rng(seed: int, grammar_name: str, index: int) -> random.Random:
+    """
+    Return the random generator of a single example, keyed by (seed, grammar name, example index).
+    The key is hashed with blake2b, so example i can be generated directly without generating the examples before it,
+    and the same example is obtained on any machine or process.
+    """
+
+    key = f"{seed}:{grammar_name}:{index}".encode("utf-8")
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+
+    return random.Random(int.from_bytes(digest, "big"))
+
+
+# Abstract feature values used by the static analysis (constants stand for themselves)
+UNBOUND = None # The feature is absent from the context
+VARIABLE = "?" # The feature holds a variable
+
+
+class GrammarAnalysis:
+    """Class for the result of the static analysis of a grammar (see CFG.analyze)."""
+
+    def __init__(self, grammar: "CFG") -> None:
+        """
+        Initialize an empty analysis.
+
+        -   grammar (CFG): the analyzed grammar.
+        -   unreachable (Set[str]): the non-terminals that can never be expanded from the axiom.
+        -   unproductive (Set[str]): the non-terminals that can never derive a sequence of terminals.
+        -   dead_rules (Dict[int, str]): the rule IDs of the rules that can never be applied,
+            with the reason ("unproductive", "unsatisfiable" or "unreachable").
+        -   contexts (Dict[str, Dict[str, Set[Any]]]): for each reachable non-terminal, an over-approximation of
+            the values each feature can take in the context of its nodes (UNBOUND or VARIABLE for free features).
+        """
+
+        self.grammar: "CFG" = grammar
+        self.unreachable: Set[str] = set()
+        self.unproductive: Set[str] = set()
+        self.dead_rules: Dict[int, str] = {}
+        self.contexts: Dict[str, Dict[str, Set[Any]]] = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Export the analysis as a JSON-serializable dict, with rules rendered as strings."""
+
+        return {
+            "rules": len(self.grammar.rules),
+            "dead_rules": [
+                {"rule": self.grammar.rule_string(rule_id), "reason": reason}
+                for rule_id, reason in sorted(self.dead_rules.items())
+            ],
+            "unreachable": sorted(self.unreachable),
+            "unproductive": sorted(self.unproductive),
+        }
+
+    def __str__(self) -> str:
+        """Report of the dead rules and non-terminals."""
+
+        lines = [f"{len(self.dead_rules)} dead rule(s) out of {len(self.grammar.rules)}"]
+
+        if self.unreachable:
+            lines.append(f"Unreachable non-terminals: {', '.join(sorted(self.unreachable))}")
+        if self.unproductive:
+            lines.append(f"Unproductive non-terminals: {', '.join(sorted(self.unproductive))}")
+
+        for rule_id, reason in sorted(self.dead_rules.items()):
+            lines.append(f"   - [{reason}] {self.grammar.rule_string(rule_id)}")
+
+        return "\n".join(lines)
 
 
 class CFG:
     "Class for the context-free grammar."
 
-    def __init__(self, rules: List[Rule], axiom: str) -> None:
+    def __init__(self, rules: List[Rule], axiom: str, name: str = "") -> None:
         """
         Initialize the CFG with a list of rules and an axiom (starting non-terminal symbol).
         It collects non-terminals, terminals, and builds mappings from non-terminals to their rules.
-        It also normalizes rule probabilities for each non-terminal to sum to 1.0.
+        It also normalizes rule probabilities for each non-terminal to sum to 1.0, in a view owned by the grammar:
+        the rules themselves are never modified, so they can be shared between grammars (e.g., a Lexicon).
+        The grammar can then be updated in place with add_rules and remove_rules.
 
-        -   rules (List[Rule]): a list of CFG rules.
+        -   rules (List[Rule]): a list of CFG rules (the list is only copied by the first update).
         -   axiom (str): the starting non-terminal symbol of the grammar.
+        -   name (str): the name of the grammar, part of the key of counter-based sampling (see example_rng).
         -   non_terminals (set): the set of non-terminal symbols N gathered from the left-hand side of the rules.
         -   terminals (set): the set of terminal symbols collected from the right-hand side of rules that are not in non-terminals.
+        -   references (Counter): the number of occurrences of each symbol in the right-hand sides of the rules.
+        -   rule_counts (Counter): the number of rules equal to each rule (same left and right sides), to skip duplicates on update.
         -   mappings (Dict): a dictionary that maps each non-terminal to its corresponding rules.
+        -   weights (Dict): a dictionary that maps each non-terminal to the normalized probabilities of its rules, in mappings order.
+        -   probs (List[float]): the normalized probability of each rule, by index in rules.
+        -   rule_ids (Dict): a dictionary that maps each rule (by identity) to its index in rules.
+        -   detokenizer (Detokenizer): joins token sequences using attributes precomputed for the terminals.
+        -   stats (Optional[GenerationStats]): rule selection statistics, only collected once enabled.
+        -   coverage (Optional[CoverageQuotas]): the usage counters of coverage-targeted sampling, once enabled.
+        -   templates (Optional[TemplateGrammar]): the grammar flattened into templates, compiled on first use (see template_engine).
         """
 
         self.rules: List[Rule] = rules
         self.axiom: str = axiom
+        self.name: str = name
         self.non_terminals: Set[str] = set(rule.left for rule in self.rules)
         self.terminals: Set[str] = set()
         self.mappings: DefaultDict[str, List[Rule]] = defaultdict(list)
+        self.references: Counter = Counter(symbol for rule in self.rules for symbol in rule.right)
+        self.rule_counts: Counter = Counter(self.rules)
+
+        # The rules list belongs to the caller until the grammar is updated (see own_rules)
+        self.owns_rules: bool = False
 
         # Populate the set of terminals
-        for rule in self.rules:
-            for symbol in rule.right:
-                if symbol not in self.non_terminals:
-                    self.terminals.add(symbol)
+        for symbol in self.references:
+            if symbol not in self.non_terminals:
+                self.terminals.add(symbol)
+
+        # Precompute the detokenization attributes of the terminals
+        self.detokenizer: Detokenizer = Detokenizer(self.terminals)
 
         # Build mappings
         for rule in self.rules:
             self.mappings[rule.left].append(rule)
 
+        # Rule IDs (positions in self.rules) used to record compact derivations
+        self.rule_ids: Dict[int, int] = {id(rule): i for i, rule in enumerate(self.rules)}
+
+        # Opt-in generation statistics (see enable_stats)
+        self.stats: Optional[GenerationStats] = None
+
+        # Opt-in coverage-targeted sampling (see enable_coverage)
+        self.coverage: Optional[CoverageQuotas] = None
+
+        # Template engine, compiled on first use
+        self.templates: Optional[TemplateGrammar] = None
+        self.templates_compiled: bool = False
+
         # Normalize rule probabilities for each non-terminal to sum to 1.0
-        for non_terminal, rules_for_non_terminal in self.mappings.items():
-            total_probability = sum(rule.prob for rule in rules_for_non_terminal)
+        self.weights: Dict[str, List[float]] = {}
+        self.probs: List[float] = [rule.prob for rule in self.rules]
+
+        for non_terminal in self.mappings:
+            self.normalize(non_terminal)
 
-            # If it is not the case: auto-normalize
-            if abs(total_probability - 1.0) > 1e-6:
+    def normalize(self, non_terminal: str, verbose: bool = True) -> None:
+        """
+        Normalize the probabilities of the rules of a non-terminal to sum to 1.0, in weights and probs.
+
+        -   non_terminal (str): the non-terminal whose rules are normalized.
+        -   verbose (bool): if True, report the non-terminals whose probabilities did not sum to 1.0.
+        """
+
+        rules_for_non_terminal = self.mappings[non_terminal]
+        weights = [rule.prob for rule in rules_for_non_terminal]
+        total_probability = sum(weights)
+
+        # If it is not the case: auto-normalize
+        if abs(total_probability - 1.0) > 1e-6:
+            if verbose:
                 print(
                     f"[INFO] Normalizing rule probabilities for '{non_terminal}' "
                     f"(sum was {total_probability:.2f})."
                 )
-                
-                # Each possible rule of a non terminal will get same value
-                for rule in rules_for_non_terminal:
-                    rule.prob /= total_probability
+
+            # Each possible rule of a non terminal will get same value
+            weights = [weight / total_probability for weight in weights]
+
+        self.weights[non_terminal] = weights
+        for rule, weight in zip(rules_for_non_terminal, weights):
+            self.probs[self.rule_ids[id(rule)]] = weight
+
+    def own_rules(self) -> None:
+        """Copy the rules list before the first update, so that the lists and grammars sharing it are not affected."""
+
+        if not self.owns_rules:
+            self.rules = list(self.rules)
+            self.owns_rules = True
+
+    def add_rules(self, rules: Iterable[Rule]) -> List[Rule]:
+        """
+        Add rules to the grammar in place (e.g., new lexical items), without rebuilding it:
+        the symbol sets, mappings and rule IDs are updated for the new rules only, and only the non-terminals
+        receiving rules are renormalized. Rules equal to a rule of the grammar (same left and right sides) are skipped.
+        New rules get the next rule IDs, so the IDs of the existing rules (and recorded derivations) remain valid.
+        Returns the added rules.
+        """
+
+        self.own_rules()
+        added: List[Rule] = []
+
+        for rule in rules:
+            if self.rule_counts[rule]:
+                continue
+
+            self.rule_counts[rule] += 1
+            self.rule_ids[id(rule)] = len(self.rules)
+            self.rules.append(rule)
+            self.probs.append(rule.prob)
+            self.mappings[rule.left].append(rule)
+
+            # A symbol getting rules is no longer a terminal
+            if rule.left not in self.non_terminals:
+                self.non_terminals.add(rule.left)
+                self.terminals.discard(rule.left)
+
+            for symbol in rule.right:
+                self.references[symbol] += 1
+                if symbol not in self.non_terminals and symbol not in self.terminals:
+                    self.terminals.add(symbol)
+                    self.detokenizer.add(symbol)
+
+            added.append(rule)
+
+        self.invalidate(set(rule.left for rule in added), added)
+
+        return added
+
+    def remove_rules(self, rules: Iterable[Rule]) -> List[Rule]:
+        """
+        Remove the rules equal to the given ones (same left and right sides) from the grammar in place, without
+        rebuilding it: only the non-terminals losing rules are updated and renormalized. To avoid shifting every
+        rule ID, the last rule of the grammar takes the position (and rule ID) of each removed rule, so derivations
+        recorded before the update cannot be replayed; the counters of generation statistics and coverage are remapped.
+        Returns the removed rules.
+        """
+
+        self.own_rules()
+        targets = set(rule for rule in rules if self.rule_counts[rule])
+        removed: List[Rule] = []
+
+        # Counters keyed by rule ID
+        counters = []
+        if self.stats is not None:
+            counters.append(self.stats.selections)
+        if self.coverage is not None:
+            counters.append(self.coverage.uses)
+
+        for non_terminal in set(rule.left for rule in targets):
+            kept = []
+            for rule in self.mappings[non_terminal]:
+                if rule in targets:
+                    removed.append(rule)
+                else:
+                    kept.append(rule)
+            self.mappings[non_terminal] = kept
+
+            # A symbol without rules becomes a terminal again if some rule still uses it
+            if not kept:
+                del self.mappings[non_terminal]
+                del self.weights[non_terminal]
+                self.non_terminals.discard(non_terminal)
+                if self.references[non_terminal]:
+                    self.terminals.add(non_terminal)
+                    self.detokenizer.add(non_terminal)
+
+        for rule in removed:
+            self.rule_counts[rule] -= 1
+            if not self.rule_counts[rule]:
+                del self.rule_counts[rule]
+
+            # Move the last rule to the position of the removed one
+            rule_id = self.rule_ids.pop(id(rule))
+            last_id = len(self.rules) - 1
+            last = self.rules.pop()
+            last_prob = self.probs.pop()
+            for counter in counters:
+                counter.pop(rule_id, None)
+
+            if rule_id != last_id:
+                self.rules[rule_id] = last
+                self.probs[rule_id] = last_prob
+                self.rule_ids[id(last)] = rule_id
+                for counter in counters:
+                    if last_id in counter:
+                        counter[rule_id] = counter.pop(last_id)
+
+            for symbol in rule.right:
+                self.references[symbol] -= 1
+                if not self.references[symbol]:
+                    del self.references[symbol]
+                    self.terminals.discard(symbol)
+
+        self.invalidate(set(rule.left for rule in removed))
+
+        return removed
+
+    def invalidate(self, non_terminals: Set[str], added: Sequence[Rule] = ()) -> None:
+        """
+        After an update, renormalize the updated non-terminals and patch the slots of the template engine drawing from them
+        (added are the rules added by the update). The template engine is only dropped (and recompiled on next use)
+        when the update changes its structure (see TemplateGrammar.update).
+        """
+
+        for non_terminal in non_terminals:
+            if non_terminal in self.mappings:
+                self.normalize(non_terminal, verbose=False)
+
+        if self.templates is not None and self.templates.update(non_terminals, added):
+            return
+
+        self.templates = None
+        self.templates_compiled = False
+
+    def analyze(self) -> GrammarAnalysis:
+        """
+        Statically find the rules that can never be applied:
+        rules using unproductive non-terminals (that cannot derive terminals),
+        rules whose constant features never unify with any context of their non-terminal,
+        and rules of non-terminals that cannot be reached from the axiom.
+        Removing a rule can make others dead, so the passes are repeated until nothing changes.
+        The feature contexts are over-approximated, so a rule reported as dead is never applicable.
+        """
+
+        analysis = GrammarAnalysis(self)
+        live: Set[int] = set(range(len(self.rules)))
+
+        while True:
+
+            # Productive non-terminals: those with a live rule whose non-terminals are all productive
+            productive: Set[str] = set()
+            changed = True
+            while changed:
+                changed = False
+                for rule_id in live:
+                    rule = self.rules[rule_id]
+                    if rule.left not in productive and all(not self.is_non_terminal(symbol) or symbol in productive for symbol in rule.right):
+                        productive.add(rule.left)
+                        changed = True
+
+            dead = {
+                rule_id: "unproductive" for rule_id in live
+                if any(self.is_non_terminal(symbol) and symbol not in productive for symbol in self.rules[rule_id].right)
+            }
+
+            # Rules that never unify with the contexts of their non-terminal
+            if not dead:
+                contexts = self.feature_contexts(live)
+                dead = {
+                    rule_id: "unsatisfiable" for rule_id in live
+                    if self.rules[rule_id].left in contexts and not self.satisfiable(self.rules[rule_id], contexts[self.rules[rule_id].left])
+                }
+
+            if not dead:
+                break
+
+            analysis.dead_rules.update(dead)
+            live -= set(dead)
+
+        # Rules of the non-terminals that no context reaches
+        for rule_id in live:
+            if self.rules[rule_id].left not in contexts:
+                analysis.dead_rules[rule_id] = "unreachable"
+
+        analysis.contexts = contexts
+        analysis.unproductive = self.non_terminals - productive
+        analysis.unreachable = self.non_terminals - set(contexts) - analysis.unproductive
+
+        return analysis
+
+    def feature_contexts(self, live: Set[int]) -> Dict[str, Dict[str, Set[Any]]]:
+        """
+        Compute, for each non-terminal reachable from the axiom with the live rules,
+        the possible values of each feature in the context of its nodes.
+        A context combines the features inherited from the parent rule and the bindings recorded
+        by the children of earlier nodes with the same label; both are propagated until a fixpoint.
+        Features are tracked independently, which over-approximates the possible contexts.
+        """
+
+        features = sorted(set(feature for rule in self.rules for feature in rule.features))
+        contexts: Dict[str, Dict[str, Set[Any]]] = {self.axiom: {feature: {UNBOUND} for feature in features}}
+
+        # Labels of the parents of each non-terminal (where its bindings are recorded)
+        parents: DefaultDict[str, Set[str]] = defaultdict(set)
+        for rule_id in live:
+            for symbol in self.rules[rule_id].right:
+                if self.is_non_terminal(symbol):
+                    parents[symbol].add(self.rules[rule_id].left)
+
+        changed = True
+        while changed:
+            changed = False
+
+            for rule_id in sorted(live):
+                rule = self.rules[rule_id]
+                context = contexts.get(rule.left)
+
+                if context is None or not self.satisfiable(rule, context):
+                    continue
+
+                # Possible merged values of each feature when the rule is applied
+                merged = {feature: self.merge_values(context[feature], rule.features.get(feature)) for feature in features}
+
+                # Children inherit the merged features, and bound features are recorded in the context of the parent label
+                recorded = {feature: values - {UNBOUND} for feature, values in merged.items()}
+                updates = [(symbol, merged) for symbol in rule.right if self.is_non_terminal(symbol)]
+                updates += [(parent, recorded) for parent in parents[rule.left] if parent in contexts]
+
+                for target, values_by_feature in updates:
+                    if target not in contexts:
+                        contexts[target] = {feature: set() for feature in features}
+                        changed = True
+
+                    for feature, values in values_by_feature.items():
+                        if not values <= contexts[target][feature]:
+                            contexts[target][feature] |= values
+                            changed = True
+
+        return contexts
+
+    def merge_values(self, values: Set[Any], rule_value: Any) -> Set[Any]:
+        """Abstract counterpart of unify for a single feature: the possible merged values, given the possible context values."""
+
+        if rule_value is None:
+            return set(values)
+
+        # A variable takes the context value, or stays a variable
+        if self.is_variable(rule_value):
+            return set(value if value is not UNBOUND else VARIABLE for value in values)
+
+        # A constant unifies with a free feature or the same constant
+        return {rule_value} if values & {UNBOUND, VARIABLE, rule_value} else set()
+
+    def satisfiable(self, rule: Rule, context: Dict[str, Set[Any]]) -> bool:
+        """Check if the constant features of a rule can unify with some value of the context, feature by feature."""
+
+        for feature, value in rule.features.items():
+            if not self.is_variable(value) and not context.get(feature, {UNBOUND}) & {UNBOUND, VARIABLE, value}:
+                return False
+
+        return True
+
+    def prune(self, analysis: Optional[GrammarAnalysis] = None) -> "CFG":
+        """
+        Return a new grammar without the dead rules found by analyze (or by the given analysis).
+        The remaining rules are shared, not copied. Dead rules are never selected,
+        so the pruned grammar samples the same distribution with fewer unification attempts.
+        """
+
+        if analysis is None:
+            analysis = self.analyze()
+
+        rules = [rule for rule_id, rule in enumerate(self.rules) if rule_id not in analysis.dead_rules]
+
+        return CFG(rules=rules, axiom=self.axiom, name=self.name)
+
+    def rule_string(self, rule_id: int) -> str:
+        """String representation of a rule with its normalized probability in this grammar."""
+
+        rule = self.rules[rule_id]
+
+        return str(Rule(rule.left, rule.right, self.probs[rule_id], rule.features))
 
     def is_terminal(self, symbol: str) -> bool:
         """Helper. Checks if a symbol is terminal."""
@@ -66,11 +602,94 @@ class CFG:
 
         return isinstance(value, str) and value.startswith('?')
 
-    def generate(self, verbose=False):
-        """Generate a grammar tree."""
+    def select_rule(self, state: DerivationState, node_label: str, node_features: Dict[str, Any], parent_label: Optional[str], rule_id: Optional[int] = None) -> tuple[Rule, Dict[str, Any]]:
+        """
+        Select a rule for a non-terminal node and record the resulting variable bindings in the derivation state.
+        The rule is sampled among the candidates that unify with the node context (favoring the least used ones
+        if coverage-targeted sampling is enabled), unless a rule_id is provided, in which case that rule is replayed.
+
+        -   state (DerivationState): the state of the current derivation.
+        -   node_label (str): the non-terminal symbol to expand.
+        -   node_features (Dict[str, Any]): the feature bundle of the node.
+        -   parent_label (Optional[str]): the label of the parent node, used to record bindings.
+        -   rule_id (Optional[int]): index in self.rules of the rule to apply (default: sample one).
+        """
+
+        # Get the local bindings for this non terminal
+        local_bindings = state.feature_bindings.get(node_label, {})
+
+        # Assert that the node is a non-terminal or raise error
+        assert self.is_non_terminal(node_label), (
+            f"Unknown symbol: {node_label}"
+        )
 
-        # Non terminal feature bindings: initialize an empty dict for each non-terminal
-        self.feature_bindings: Dict[str, Dict[str, Any]] = {non_terminal: {} for non_terminal in self.mappings}
+        # Retrieve applicable rules for this non-terminal
+        applicable_rules = self.mappings[node_label]
+
+        # Filter by feature unification
+        candidates = []
+        weights = []
+        for rule, weight in zip(applicable_rules, self.weights[node_label]):
+            context = {**node_features, **local_bindings}
+            merged_features = unify(context, rule.features)
+
+            if merged_features is not None:
+                candidates.append((rule, merged_features))
+                weights.append(weight)
+
+        # Record the work done for this expansion
+        stats = self.stats
+        if stats is not None:
+            with stats.lock:
+                stats.expansions[node_label] += 1
+                stats.candidates[node_label] += len(candidates)
+                stats.unify_calls[node_label] += len(applicable_rules)
+                stats.unify_failures[node_label] += len(applicable_rules) - len(candidates)
+                if not candidates:
+                    stats.dead_ends[node_label] += 1
+
+        if not candidates:
+            raise DeadEndError(f"No applicable rules for {node_label} with features {node_features}")
+
+        # Replay the requested rule, otherwise sample one rule according to weights
+        if rule_id is not None:
+            replayed = [(rule, features) for rule, features in candidates if rule is self.rules[rule_id]]
+            assert replayed, f"Rule {rule_id} ({self.rules[rule_id]}) does not apply to {node_label}"
+            selected_rule, selected_features = replayed[0]
+        elif self.coverage is not None:
+            selected = self.coverage.select(state.rng, [self.rule_ids[id(rule)] for rule, _ in candidates], weights)
+            selected_rule, selected_features = candidates[selected]
+        else:
+            selected_rule, selected_features = state.rng.choices(candidates, weights=weights, k=1)[0]
+
+        # Record any variable→constant binding in the parent non-terminal
+        if parent_label is not None and self.is_non_terminal(parent_label):
+            for feature, value in selected_features.items():
+                node_value = node_features.get(feature)
+                rule_value = selected_rule.features.get(feature)
+                if self.is_variable(node_value) or self.is_variable(rule_value):
+                    state.feature_bindings.setdefault(parent_label, {})[feature] = value
+
+        if stats is not None:
+            with stats.lock:
+                stats.selections[self.rule_ids[id(selected_rule)]] += 1
+
+        return selected_rule, selected_features
+
+    @profiler.timed("cfg.generate")
+    def generate(self, verbose=False, derivation: Optional[List[int]] = None, rng: Optional[random.Random] = None):
+        """
+        Generate a grammar tree.
+        If a derivation (a sequence of rule IDs as returned by generate_yield) is provided,
+        the tree is rebuilt by replaying it instead of sampling.
+        Rules are sampled with rng if provided, and with the global random module otherwise.
+        """
+
+        # Per-call state: the grammar itself is only read, so it can be shared across threads
+        state = DerivationState(rng)
+
+        # Rule IDs to replay, consumed in the same pre-order as the sampling loop
+        replay = iter(derivation) if derivation is not None else None
 
         # Initialize a tree with the axiom as the starting label
         tree: Tree = Tree(node_label=self.axiom, features={})
@@ -84,45 +703,13 @@ class CFG:
             # Processing the last node from the stack
             node, parent_label = stack.pop()
 
-            # Get the local bindings for this non terminal
-            local_bindings = self.feature_bindings.get(node.node_label, {})
-
             # Check if that node is terminal: if yes skip
             if self.is_terminal(node.node_label):
                 continue
 
-            # Assert that the node is a non-terminal or raise error
-            assert self.is_non_terminal(node.node_label), (
-                f"Unknown symbol: {node.node_label}"
-            )
-
-            # Retrieve applicable rules for this non-terminal
-            applicable_rules = self.mappings[node.node_label]
-            
-            # Filter by feature unification
-            candidates = []
-            for rule in applicable_rules:
-                context = {**node.features, **local_bindings}
-                # context = node.features
-                merged_features = unify(context, rule.features)
-
-                if merged_features is not None:
-                    candidates.append((rule, merged_features))
-                
-            # else:
-            assert candidates, f"No applicable rules for {node.node_label} with features {node.features}"
-
-            # Always sample one rule according to weights
-            weights = [rule.prob for rule, _ in candidates]
-            selected_rule, selected_features = random.choices(candidates, weights=weights, k=1)[0]
-
-            # Record any variable→constant binding in the parent non-terminal
-            if parent_label in self.feature_bindings:
-                for feature, value in selected_features.items():
-                    node_value = node.features.get(feature)
-                    rule_value = selected_rule.features.get(feature)
-                    if self.is_variable(node_value) or self.is_variable(rule_value):
-                        self.feature_bindings[parent_label][feature] = value
+            # Select a rule (sampled or replayed) and bind variables
+            rule_id = next(replay) if replay is not None else None
+            selected_rule, selected_features = self.select_rule(state, node.node_label, node.features, parent_label, rule_id)
 
             # Create children with current global variable bindings
             node.children = [
@@ -140,14 +727,120 @@ class CFG:
                 print(f"Current tree: {tree}")
         
         return tree
+
+    @profiler.timed("cfg.generate_yield")
+    def generate_yield(
+        self,
+        derivation: bool = False,
+        rng: Optional[random.Random] = None,
+        spans: Optional[Sequence[str]] = None
+    ) -> List[str] | Dict[str, List[str]] | tuple[List[str] | Dict[str, List[str]], List[int]]:
+        """
+        Generate the terminal yield of a derivation in a single expansion pass, without building a Tree.
+        It samples exactly like generate, so the same random state yields the same tokens as generate().output().
+
+        -   derivation (bool): if True, also return the sequence of applied rule IDs (indices in self.rules),
+            which can be passed to generate() to reconstruct the full tree.
+        -   rng (Optional[random.Random]): the random generator used to sample rules (the global random module by default).
+        -   spans (Optional[Sequence[str]]): if given, return instead the yield of the subtrees of each of these
+            non-terminals (e.g., "<PREMISE>" and "<HYPOTHESIS>"), as a dict of token lists (the yields of
+            several subtrees with the same label are concatenated). Terminals outside these subtrees are dropped.
+        """
+
+        # Per-call state: the grammar itself is only read, so it can be shared across threads
+        state = DerivationState(rng)
+
+        tokens: List[str] = []
+        rule_ids: List[int] = []
+
+        # Token lists receiving the terminals: the whole yield, or the yields of the open designated subtrees
+        span_tokens: Dict[str, List[str]] = {label: [] for label in spans} if spans is not None else {}
+        outputs: List[List[str]] = [tokens] if spans is None else []
+        open_spans: List[str] = []
+
+        # Stack holds tuples of (symbol, features, parent_label), and (None, None, None) to close a designated subtree
+        stack: List[tuple[Optional[str], Optional[Dict[str, Any]], Optional[str]]] = [(self.axiom, {}, None)]
+
+        while stack:
+            label, features, parent_label = stack.pop()
+
+            # End of a designated subtree
+            if label is None:
+                outputs.pop()
+                open_spans.pop()
+                continue
+
+            # Terminal symbols go straight to the output
+            if self.is_terminal(label):
+                for output in outputs:
+                    output.append(label)
+                continue
+
+            selected_rule, selected_features = self.select_rule(state, label, features, parent_label)
+
+            if derivation:
+                rule_ids.append(self.rule_ids[id(selected_rule)])
+
+            # Start of a designated subtree (unless one with the same label is already open)
+            if label in span_tokens and label not in open_spans:
+                outputs.append(span_tokens[label])
+                open_spans.append(label)
+                stack.append((None, None, None))
+
+            # A node expanded with an empty rule is a leaf of the tree: keep its label like Tree.output
+            if not selected_rule.right:
+                for output in outputs:
+                    output.append(label)
+
+            # Push children in reverse order to process them left to right
+            for symbol in reversed(selected_rule.right):
+                stack.append((symbol, selected_features, label))
+
+        result = span_tokens if spans is not None else tokens
+
+        if derivation:
+            return result, rule_ids
+
+        return result
     
+    def template_engine(self) -> Optional[TemplateGrammar]:
+        """
+        Return the grammar flattened into templates (see source.templates), compiled once,
+        or None if the grammar falls outside the template family and must be sampled by generate_yield.
+        """
+
+        if not self.templates_compiled:
+            with profiler.timer("cfg.flatten"):
+                self.templates = flatten(self)
+            self.templates_compiled = True
+
+        return self.templates
+
+    def enable_stats(self) -> GenerationStats:
+        """Start collecting generation statistics (resetting any previous ones) and return them."""
+
+        self.stats = GenerationStats()
+
+        return self.stats
+
+    def enable_coverage(self, min_uses: Optional[int] = None) -> CoverageQuotas:
+        """
+        Start coverage-targeted sampling (resetting any previous usage counts) and return the counters.
+        The usage counts are shared by all the following derivations, so examples are no longer independent:
+        with a seed, an example can only be regenerated together with the examples sampled before it.
+        """
+
+        self.coverage = CoverageQuotas(min_uses)
+
+        return self.coverage
+
     def __str__(self) -> str:
         """String representation of the rule."""
 
         # Format nicely the elements of the CFG
         formatted_terminals = "\n   - ".join(str(t) for t in self.terminals)
         formatted_non_terminals = "\n   - ".join(str(nt) for nt in self.non_terminals)
-        formatted_rules = "\n   - ".join(str(rule) for rule in self.rules)
+        formatted_rules = "\n   - ".join(self.rule_string(i) for i in range(len(self.rules)))
 
         context_free_grammar = (
             "CFG/PCFG: a tuple containing:\n\n"
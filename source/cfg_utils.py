@@ -1,4 +1,4 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable
 
 
 class Rule:
@@ -169,6 +169,90 @@ def join(tokens: List[str]) -> str:
     return result
 
 
+class Detokenizer:
+    """Class to join token sequences from a fixed terminal vocabulary, equivalent to join()."""
+
+    # Tokens that attach to the previous token and tokens after which the next one is capitalized
+    NO_SPACE_BEFORE = {".", "?", ",", ":", " "}
+    CAPITALIZE_AFTER = {".", "?", "!", ":", "]"}
+
+    def __init__(self, vocabulary: Iterable[str] = ()) -> None:
+        """
+        Precompute the attributes of each terminal of the vocabulary.
+
+        -   vocabulary (Iterable[str]): the terminal symbols of a grammar.
+        -   attributes (Dict): maps each token to (needs leading space, capitalizes next, capitalized form).
+        """
+
+        self.attributes: Dict[str, tuple[bool, bool, str]] = {}
+
+        for token in vocabulary:
+            self.add(token)
+
+    def add(self, token: str) -> tuple[bool, bool, str]:
+        """Compute and store the attributes of a token (empty tokens are skipped by join)."""
+
+        if token == "":
+            return (False, False, "")
+
+        attributes = (
+            token[0] not in self.NO_SPACE_BEFORE,
+            token[-1] in self.CAPITALIZE_AFTER,
+            token[0].upper() + token[1:],
+        )
+        self.attributes[token] = attributes
+
+        return attributes
+
+    def join(self, tokens: List[str]) -> str:
+        """Join a list of tokens into a single string, with the same output as join()."""
+
+        parts: List[str] = []
+        capitalize_next = False
+
+        for i, token in enumerate(tokens):
+
+            # Skip empty tokens
+            if token == "": continue
+
+            # Tokens outside the vocabulary are added on the fly
+            attributes = self.attributes.get(token)
+            if attributes is None:
+                attributes = self.add(token)
+            space_before, capitalizes_next, capitalized = attributes
+
+            # Specific punctuation tokens need no space before them
+            if i > 0 and space_before:
+                parts.append(" ")
+
+            # Capitalize first character after punctuation
+            if capitalize_next:
+                parts.append(capitalized)
+            else:
+                parts.append(token)
+
+            # If this token ends with punctuation, capitalize the next token
+            capitalize_next = capitalizes_next
+
+        # Join the elements of the list
+        result = "".join(parts).lstrip()
+
+        # Capitalize first char if it is a letter
+        if result and result[0].isalpha():
+            result = result[0].upper() + result[1:]
+
+        return result
+
+    def join_many(self, sequences: Iterable[List[str]]) -> List[str]:
+        """Join a batch of token sequences."""
+
+        return [self.join(tokens) for tokens in sequences]
+
+
+class DeadEndError(AssertionError):
+    """Raised when a derivation reaches a non-terminal without any applicable rule."""
+
+
 def unify(node_features: Dict[str, Any], rule_features: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """
     Merge two feature dicts if compatible, binding variables.
@@ -1,23 +1,93 @@
 import os
+import gc
+import csv
+import json
+from collections import Counter
 import torch
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
+import numpy as np
 from scipy.stats import entropy
-from matplotlib.ticker import MaxNLocator
 from transformers import AutoModelForSequenceClassification, AutoTokenizer, logging
+from source.profiling import profiler
 
 # Silence expected unused weight warnings from transformers
 logging.set_verbosity_error()
 
 
-def load_nli_model(model_name: str):
+# Canonical order of the NLI classes: probability columns and class IDs of all results follow it
+CANONICAL_LABELS = ["entailment", "neutral", "contradiction"]
+
+
+class Results:
+    """Class for the evaluation results of a set of pairs, stored as numeric arrays."""
+
+    def __init__(self, pairs, probs, classes=CANONICAL_LABELS) -> None:
+        """
+        Initialize the results and derive the predicted class IDs.
+
+        - pairs (List[tuple[str, str]]): the premise/hypothesis pairs.
+        - probs (np.ndarray): the (pairs x classes) probabilities, columns ordered like classes.
+        - classes (List[str]): the class of each column (default: the canonical labels).
+        - pred_ids (np.ndarray): the predicted class ID (column index) of each pair.
+        """
+
+        self.pairs = pairs
+        self.probs = np.asarray(probs, dtype=float)
+        self.classes = list(classes)
+        self.pred_ids = self.probs.argmax(axis=1)
+
+    def labels(self):
+        """Return the predicted label of each pair."""
+
+        return [self.classes[pred_id] for pred_id in self.pred_ids]
+
+    def entropies(self, base=2):
+        """Return the entropy of the predicted distribution of each pair."""
+
+        return entropy(self.probs, base=base, axis=1)
+
+    def label_counts(self):
+        """Return the number of pairs predicted for each class."""
+
+        return np.bincount(self.pred_ids, minlength=len(self.classes))
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+
+def label_order(id2label):
+    """
+    Compute the model column of each canonical label, so that probabilities of any checkpoint
+    can be realigned with probs[:, order].
+    Returns the order and the resulting classes; models whose labels are not the canonical
+    ones keep their own order and (lowercased) labels.
+
+    - id2label (Dict[int, str]): the model's mapping from column index to label.
+    """
+
+    columns = {label.lower(): int(i) for i, label in id2label.items()}
+
+    if set(columns) == set(CANONICAL_LABELS):
+        return [columns[label] for label in CANONICAL_LABELS], list(CANONICAL_LABELS)
+
+    print(f"[WARNING] Labels {sorted(columns)} do not match {CANONICAL_LABELS}: keeping the model order.")
+    order = sorted(int(i) for i in id2label)
+
+    return order, [id2label[i].lower() for i in order]
+
+
+@profiler.timed("load_nli_model")
+def load_nli_model(model_name: str, backend: str = "torch"):
     """
     Helper function to load a tokenizer and NLI model by name from HuggingFace.
     
     - model_name (str): the model name taken from HuggingFace.
+    - backend (str): "torch", or "onnx" to run the model with onnxruntime (see source.onnx_backend).
     """
 
+    if backend == "onnx":
+        from source.onnx_backend import load_onnx_model
+        return load_onnx_model(model_name)
+
     tokenizer = AutoTokenizer.from_pretrained(model_name)
     model = AutoModelForSequenceClassification.from_pretrained(model_name)
     model.eval()
@@ -25,86 +95,33 @@ def load_nli_model(model_name: str):
     return tokenizer, model
 
 
-def plot_bar(probs, classes, base_dir, key_name):
-    """
-    Helper function to plot model's output for each example.
-    
-    - probs (List[List[float]]): a list of lists containing the probability for each class, for each example.
-    - classes (List[str]): the classes (output labels).
-    - base_dir: (str): directory to save plot
+def load_truncated_model(model_name: str, num_layers: int):
     """
+    Load a model keeping only its first num_layers encoder layers, as a cheap variant of the full model.
+    The classification head is applied directly on the output of the last kept layer.
 
-    # Path to store the figure
-    path = os.path.join(base_dir, f"graph_{key_name}.png")
-    print(f"Saving plot to {path}")
-
-    # Convert probabilities to pandas DataFrame
-    df = pd.DataFrame(probs, columns=classes, index=range(len(probs)))
+    - model_name (str): the model name taken from HuggingFace.
+    - num_layers (int): the number of encoder layers to keep.
+    """
 
-    # Create figure
-    figure = df.plot(kind='bar', rot=0, stacked=True)
-    figure.set(title=key_name, xlabel="Example IDs", ylabel="Probabilities")
-    figure.xaxis.set_major_locator(MaxNLocator(nbins=20))
-    
-    # Save
-    plt.tight_layout()
-    plt.savefig(path, dpi=300)
-    plt.close()
-
-
-def plot_mustache(all_entropies, results_dir):
-    """Helper function to plot model output distributions for each grammar across all examples."""
-
-    # Set path
-    path = os.path.join(results_dir, "cross_grammar_entropy_boxplot.png")
-    print(f"Saving mustache plot to {path}")
-
-    # Convert to DataFrame
-    df = pd.DataFrame(all_entropies)
-
-    # Rename columns to numeric indices for x-axis
-    index_map = {i + 1: name for i, name in enumerate(df.columns)}
-    df.columns = list(index_map.keys())
-
-    # Create boxplot
-    figure = df.boxplot(grid=False, patch_artist=True)
-    figure.set(title="Cross-Grammar Entropy", xlabel="Sub-grammars", ylabel="Entropy (bits)")
-
-    # Add legend using the mapping
-    legend_patches = [mpatches.Patch(label=f"{i}: {name}") for i, name in index_map.items()]
-    figure.legend(
-        handles=legend_patches,
-        title="Legend",
-        loc="center right",
-        bbox_to_anchor=(-0.115, 0.5),
-        fontsize="small"
-    )
+    tokenizer, model = load_nli_model(model_name)
 
-    # Save plot
-    plt.savefig(path, bbox_inches="tight", dpi=300)
-    plt.close()
+    # BERT-like encoders (including RoBERTa) store their layers in base_model.encoder.layer
+    encoder = getattr(model.base_model, "encoder", None)
+    if encoder is None or not hasattr(encoder, "layer"):
+        raise ValueError(f"Cannot truncate {model_name}: no encoder.layer module list")
 
+    encoder.layer = encoder.layer[:num_layers]
+    model.config.num_hidden_layers = len(encoder.layer)
 
-def evaluate(pairs, model_name, batch_size=16):
-    """
-    Evaluation pipeline for a set of premise/hypothesis paris.
-    For now the model loaded is roberta-large-mnli.
-    Outputs a txt file with the output of the model for each pair,
-    as well as plots aggregating the results.
-    """
+    return tokenizer, model
 
-    # Set tokenizer and model
-    tokenizer, model = load_nli_model(model_name)
 
-    # Retrieve all class labels (i.e. 'Contradiction', 'Entailment', 'Neutral')
-    id2label = model.config.id2label # We use it later on
-    classes = list(id2label.values())
+def tokenize_batches(tokenizer, pairs, batch_size=16):
+    """Tokenize premise/hypothesis pairs into the list of model inputs of each batch."""
 
-    # Store evaluation results
-    results = []
+    encodings = []
 
-    # Main evaluation loop over batches of examples
-    # for batch_start in tqdm(range(0, len(pairs), batch_size), desc="Evaluating over batches"):
     for batch_start in range(0, len(pairs), batch_size):
 
         # Create batches of example pairs
@@ -112,41 +129,245 @@ def evaluate(pairs, model_name, batch_size=16):
         premises, hypotheses = map(list, zip(*batch))
 
         # Prepare the inputs for the model
-        inputs = tokenizer(
-            premises,
-            hypotheses,
-            return_tensors="pt",
-            padding=True,
-            truncation=True
-        )
+        with profiler.timer("tokenize"):
+            encodings.append(tokenizer(
+                premises,
+                hypotheses,
+                return_tensors="pt",
+                padding=True,
+                truncation=True
+            ))
+
+    return encodings
+
+
+# Pair encoded to tell apart slow tokenizers, which have no serialized pipeline to compare
+PROBE_PAIR = ("It is not the case that Élise is permitted to swim, or run!", "Élise isn't allowed to dance.")
+
+
+def tokenizer_signature(tokenizer):
+    """
+    Identify what a tokenizer produces (class, pipeline and truncation/padding settings),
+    so that models whose tokenizers match can share the same tokenized inputs.
+    The pipeline of a fast tokenizer (normalizer, pre-tokenizer, vocabulary and post-processor
+    with its special tokens) is hashed from its serialization; slow tokenizers are compared
+    through their vocabulary and their encoding of a probe pair.
+    """
+
+    if getattr(tokenizer, "is_fast", False):
+        pipeline = hash(tokenizer.backend_tokenizer.to_str())
+    else:
+        vocab = tuple(sorted(tokenizer.get_vocab().items()))
+        probe = tokenizer(*PROBE_PAIR)
+        pipeline = (hash(vocab), tuple((name, tuple(probe[name])) for name in sorted(probe.keys())))
+
+    return (
+        type(tokenizer).__name__,
+        pipeline,
+        tokenizer.model_max_length,
+        tokenizer.padding_side,
+        tokenizer.truncation_side,
+        tuple(tokenizer.model_input_names),
+    )
+
+
+def evaluate(pairs, model_name, batch_size=16, loaded=None, encodings=None):
+    """
+    Evaluation pipeline for a set of premise/hypothesis paris.
+    Returns the Results of the pairs, with probability columns realigned to the canonical
+    label order (see label_order), as well as the corresponding classes.
+
+    - pairs (List[tuple[str, str]]): the premise/hypothesis pairs.
+    - model_name (str): the HuggingFace model name, loaded unless `loaded` is given.
+    - batch_size (int): the number of pairs per forward pass.
+    - loaded (Optional[tuple]): an already loaded (tokenizer, model).
+    - encodings (Optional[List]): the pairs already tokenized with tokenize_batches and the same batch size.
+    """
+
+    # Set tokenizer and model
+    tokenizer, model = loaded if loaded is not None else load_nli_model(model_name)
+
+    # Map the model classes (i.e. 'Contradiction', 'Entailment', 'Neutral') to the canonical order
+    order, classes = label_order(model.config.id2label)
+
+    if encodings is None:
+        encodings = tokenize_batches(tokenizer, pairs, batch_size)
+
+    # Probabilities of each batch
+    batch_probs = []
+
+    # Main evaluation loop over batches of examples
+    for inputs in encodings:
 
         # Forward pass
-        with torch.inference_mode():
+        with profiler.timer("forward"), torch.inference_mode():
             logits = model(**inputs).logits
 
-        # Get the probabilities and the predicted labels
-        batch_probs = torch.softmax(logits, dim=1)
-        pred_ids = batch_probs.argmax(dim=1)
-        
-        # Each example is a tuple with premise, hypothesis, probabilities vector and predicted label
-        results.extend(
-            (premise, hypothesis, id2label[int(pred_id)], probs.tolist())
-            for (premise, hypothesis), pred_id, probs in zip(batch, pred_ids, batch_probs)
-        )
+        batch_probs.append(torch.softmax(logits, dim=1))
+
+    profiler.count("pairs evaluated", len(pairs))
+
+    # Realign the probability columns to the canonical order with a single index operation
+    probs = torch.cat(batch_probs)[:, order].numpy() if batch_probs else np.zeros((0, len(classes)))
     
-    return results, classes
+    return Results(pairs, probs, classes), classes
 
 
-def compute_entropies(pairs, model_name, batch_size=16, base=2):
-    """Evaluate a set of pairs and return only the entropy vector."""
+def evaluate_models(examples, model_names, batch_size=16, backend="torch"):
+    """
+    Evaluate every grammar key of a dataset with several models, one model at a time.
+    Each model is loaded once for all keys and freed before the next one is loaded,
+    pairs are only tokenized again when a model's tokenizer differs from the previous ones,
+    and the shared inputs are freed after the last model using them.
+    Yields (model_name, key, results, classes) for each model and key.
+
+    - examples (Dict[str, List[tuple[str, str]]]): the pairs of each grammar key.
+    - model_names (List[str]): the HuggingFace model names.
+    - batch_size (int): the number of pairs per forward pass.
+    - backend (str): the inference backend, "torch" or "onnx".
+    """
 
-    results, _ = evaluate(pairs, model_name, batch_size)
-    entropies = [entropy(probs, base=base) for (_, _, _, probs) in results]
-    
-    return entropies
+    # Number of models left to evaluate with each tokenizer signature (tokenizers are cheap to load)
+    signatures = [tokenizer_signature(AutoTokenizer.from_pretrained(model_name)) for model_name in model_names]
+    remaining = Counter(signatures)
+
+    # Tokenized inputs of each key, per tokenizer signature still in use
+    shared_encodings = {}
+
+    for model_name, signature in zip(model_names, signatures):
+        tokenizer, model = load_nli_model(model_name, backend)
+
+        if signature not in shared_encodings:
+            shared_encodings[signature] = {
+                key: tokenize_batches(tokenizer, pairs, batch_size) for key, pairs in examples.items()
+            }
+        else:
+            print(f"Reusing tokenized inputs for {model_name}")
+
+        for key, pairs in examples.items():
+            results, classes = evaluate(pairs, model_name, batch_size, (tokenizer, model), shared_encodings[signature][key])
+            yield model_name, key, results, classes
+
+        # Free the encodings once no remaining model shares them, and the model before loading the next one
+        remaining[signature] -= 1
+        if not remaining[signature]:
+            del shared_encodings[signature]
+        del tokenizer, model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def cascade_models(examples, cheap_model, model_name, threshold=0.5, batch_size=16, audit=False, backend="torch"):
+    """
+    Evaluate every grammar key with a cheap model first, and only send the pairs whose
+    entropy exceeds a threshold to the full model.
+    Yields (key, results, classes, report) for each key, where results combine the cheap
+    predictions of confident pairs with the full predictions of the escalated ones.
+
+    - examples (Dict[str, List[tuple[str, str]]]): the pairs of each grammar key.
+    - cheap_model (str): a HuggingFace model name, or "layers:N" for the full model truncated to N layers.
+    - model_name (str): the full HuggingFace model name.
+    - threshold (float): the entropy (bits) above which a pair is escalated to the full model.
+    - batch_size (int): the number of pairs per forward pass.
+    - audit (bool): also run the full model on the confident pairs, to measure the agreement of the cascade.
+    - backend (str): the inference backend of the full model, "torch" or "onnx".
+    """
+
+    # Score everything with the cheap model, then free it
+    if cheap_model.startswith("layers:"):
+        cheap = load_truncated_model(model_name, int(cheap_model.split(":", 1)[1]))
+    else:
+        cheap = load_nli_model(cheap_model)
+
+    cheap_results = {key: evaluate(pairs, cheap_model, batch_size, cheap)[0] for key, pairs in examples.items()}
+
+    del cheap
+    gc.collect()
+
+    full = load_nli_model(model_name, backend)
 
+    for key, pairs in examples.items():
+        first = cheap_results[key]
+        escalated = np.flatnonzero(first.entropies() > threshold)
 
+        # Run the full model on the escalated pairs only (or on every pair when auditing)
+        if audit:
+            reference, classes = evaluate(pairs, model_name, batch_size, full)
+            escalated_probs = reference.probs[escalated]
+        else:
+            second, classes = evaluate([pairs[i] for i in escalated], model_name, batch_size, full)
+            escalated_probs = second.probs
+
+        if first.classes != classes:
+            raise ValueError(f"Cheap model classes {first.classes} do not match full model classes {classes}")
+
+        # Keep the cheap predictions of confident pairs
+        probs = first.probs.copy()
+        probs[escalated] = escalated_probs
+        results = Results(pairs, probs, classes)
+
+        report = {
+            "pairs": len(pairs),
+            "escalated": len(escalated),
+            "savings": 1 - len(escalated) / len(pairs) if pairs else 0.0,
+            "agreement_escalated": float((first.pred_ids[escalated] == results.pred_ids[escalated]).mean()) if len(escalated) else float("nan"),
+        }
+
+        # With the full predictions of every pair, measure what the cascade changes
+        if audit:
+            confident = np.setdiff1d(np.arange(len(pairs)), escalated)
+            report["agreement_confident"] = float((first.pred_ids[confident] == reference.pred_ids[confident]).mean()) if len(confident) else float("nan")
+            report["agreement_overall"] = float((results.pred_ids == reference.pred_ids).mean()) if pairs else float("nan")
+
+        yield key, results, classes, report
+
+    del full
+    gc.collect()
+
+
+def summarize(results, base=2):
+    """Summarize the results of one key: number of pairs, entropy statistics and predicted label counts."""
+
+    entropies = results.entropies(base)
+    label_counts = results.label_counts()
+
+    return {
+        "pairs": len(results),
+        "mean_entropy": float(entropies.mean()) if len(results) else float("nan"),
+        "max_entropy": float(entropies.max()) if len(results) else float("nan"),
+        "majority_label": results.classes[int(label_counts.argmax())] if len(results) else "",
+        **{f"n_{label}": int(count) for label, count in zip(results.classes, label_counts)},
+    }
+
+
+def write_comparison(rows, results_dir):
+    """
+    Write the per-model comparison table (one row per model and grammar key) as CSV.
+
+    - rows (List[Dict]): the rows, each with "model", "grammar" and the summarize() fields.
+    """
+
+    path = os.path.join(results_dir, "comparison.csv")
+    print(f"Saving model comparison to {path}")
+
+    # Models with non-canonical labels add their own columns: use the union of all fields
+    fieldnames = []
+    for row in rows:
+        fieldnames.extend(field for field in row if field not in fieldnames)
+
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, restval=0)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+@profiler.timed("write_to_file")
 def write_to_file(results, classes, key_name, results_dir):
+    """
+    Write the results of a grammar key as a readable .txt report,
+    and persist its labels and probabilities as JSON for the plotting stage (see source.plot).
+    """
 
     # Identify the path where the results file will be stored
     out_path = os.path.join(results_dir, f"results_{key_name}.txt")
@@ -156,7 +377,7 @@ def write_to_file(results, classes, key_name, results_dir):
     with open(out_path, "w") as out_file:
 
         # Loop over each example pair and write in the file
-        for idx, (premise, hypothesis, label, probs) in enumerate(results):
+        for idx, ((premise, hypothesis), label, probs) in enumerate(zip(results.pairs, results.labels(), results.probs)):
             out_file.write(f"Example {idx}:\n")
             out_file.write(f"Premise: {premise}\nHypothesis: {hypothesis}\n")
             out_file.write(f"Prediction: {label}\n")
@@ -164,5 +385,21 @@ def write_to_file(results, classes, key_name, results_dir):
             out_file.writelines(f"\t{cls}: {prob:.4f}\n" for cls, prob in zip(classes, probs))
             out_file.write("\n")
 
-    # Plot the results
-    plot_bar([probs for (_, _, _, probs) in results], classes, results_dir, key_name)
\ No newline at end of file
+    # Persist the raw results so that plots can be rendered later, without rerunning the model
+    json_path = os.path.join(results_dir, f"results_{key_name}.json")
+    with open(json_path, "w", encoding="utf-8") as json_file:
+        json.dump({
+            "classes": list(classes),
+            "pred_ids": results.pred_ids.tolist(),
+            "probs": results.probs.tolist(),
+        }, json_file)
+
+
+def save_entropies(all_entropies, results_dir):
+    """Persist the entropies of each grammar key as JSON for the plotting stage (see source.plot)."""
+
+    path = os.path.join(results_dir, "entropies.json")
+    print(f"Saving entropies to {path}")
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({key: [float(value) for value in entropies] for key, entropies in all_entropies.items()}, f)
\ No newline at end of file
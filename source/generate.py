@@ -1,41 +1,150 @@
 import time
-from ollama import chat
+import httpx
+import asyncio
+from ollama import chat, AsyncClient, ResponseError, RequestError
 from pydantic import create_model, ConfigDict, Field, conlist
-from source.cfg import CFG
-from source.cfg_utils import join, Rule
-from typing import List, Dict, Any
+from source.cfg import CFG, example_rng
+from source.cfg_utils import Rule, DeadEndError
+from source.cache import ResponseCache
+from source.profiling import profiler
+from typing import List, Dict, Any, Optional, Iterator, Sequence
 from tqdm import tqdm
 
+# Non-terminals whose subtrees yield the premise and the hypothesis of an example
+PREMISE = "<PREMISE>"
+HYPOTHESIS = "<HYPOTHESIS>"
 
-def generate_examples(grammar: CFG, num_examples: int = 20, print_tree: bool = False) -> List[str]:
-    """Generates examples produced by a grammar."""
 
-    examples: List[str] = []
+def sample_yields(
+    grammar: CFG,
+    start: int = 0,
+    stop: int = 20,
+    seed: Optional[int] = None,
+    print_tree: bool = False,
+    use_templates: bool = True,
+    max_retries: int = 10,
+    spans: Optional[Sequence[str]] = None
+) -> Iterator[List[str] | Dict[str, List[str]]]:
+    """
+    Lazily sample the terminal yields of the examples start to stop - 1 of a grammar.
+    Without a seed, examples are sampled sequentially from the global random state.
+    With a seed, example i is sampled from its own generator keyed by (seed, grammar name, i),
+    so any index range [start, stop) can be generated independently (e.g. to shard a dataset across machines).
+    Grammars that can be flattened into templates are sampled with the template engine (same examples, faster),
+    unless trees are printed, generation statistics are collected or coverage-targeted sampling is enabled.
+    A derivation reaching a dead end (DeadEndError) is restarted, at most max_retries times per example
+    (with a seed, the retries keep drawing from the generator of the example, so they are reproducible).
+    With spans, each item is instead the dict of the yields of the subtrees of these non-terminals (see CFG.generate_yield).
+    """
 
-    # Generate examples
-    for _ in range(num_examples):
+    # Template engine if the grammar allows it, general engine otherwise
+    general = print_tree or grammar.stats is not None or grammar.coverage is not None
+    engine = grammar.template_engine() if use_templates and not general else None
+    if engine is None:
+        engine = grammar
 
-        # Generate a random tree
-        tree = grammar.generate(False)
+    for index in range(start, stop):
+        rng = example_rng(seed, grammar.name, index) if seed is not None else None
 
-        # Get the terminal yield of the tree
-        tokens = tree.output()
+        for attempt in range(max_retries + 1):
+            try:
+                # See the tree structure and the yield
+                if print_tree and spans is None:
+                    tree = grammar.generate(False, rng=rng) # Generate a random tree
+                    tokens = tree.output() # Get the terminal yield of the tree
+                    print("sampled tree:", tree) # Print the tree structure
+                    print("yield:", tokens) # Print the yield (list of tokens)
 
-        # See the tree structure and the yield
-        if print_tree:
-            print("sampled tree:", tree) # Print the tree structure
-            print("yield:", tokens) # Print the yield (list of tokens)
-        
-        example = join(tokens) # Join the tokens into a sentence
+                # Same with spans, the tree being rebuilt from the derivation
+                elif print_tree:
+                    tokens, rule_ids = grammar.generate_yield(True, rng=rng, spans=spans)
+                    print("sampled tree:", grammar.generate(False, derivation=rule_ids))
+                    print("yield:", tokens)
+
+                # Otherwise emit the terminal yield directly, without building a tree
+                else:
+                    tokens = engine.generate_yield(rng=rng, spans=spans)
+
+                break
+
+            # Restart the derivation on dead ends, unless the retries are exhausted
+            except DeadEndError:
+                if attempt == max_retries:
+                    raise
+                profiler.count("dead ends retried")
+
+        yield tokens
+
+
+@profiler.timed("generate_examples")
+def generate_examples(
+    grammar: CFG,
+    num_examples: int = 20,
+    print_tree: bool = False,
+    *,
+    start: int = 0,
+    stop: Optional[int] = None,
+    seed: Optional[int] = None,
+    use_templates: bool = True,
+    max_retries: int = 10
+) -> List[str]:
+    """
+    Generates examples produced by a grammar: num_examples examples from index start, unless stop is given.
+    The index range and the seed are keyword-only, e.g. generate_examples(grammar, start=0, stop=100, seed=7).
+    See sample_yields for the sampling options.
+    """
+
+    examples: List[str] = []
+
+    # Index range of the examples (num_examples from start unless stop is given)
+    if stop is None:
+        stop = start + num_examples
+
+    # Generate examples
+    for tokens in sample_yields(grammar, start, stop, seed, print_tree, use_templates, max_retries):
+        with profiler.timer("detokenize"):
+            example = grammar.detokenizer.join(tokens) # Join the tokens into a sentence
         examples.append(example) # Add it to the list
     
+    profiler.count("examples generated", len(examples))
+    
     return examples
 
 
-def generate_items(prompt: str,  k: int, field_names: List[str], model: str = 'mistral') -> Dict[str, List[str]]:
+def generate_pairs(
+    grammar: CFG,
+    num_examples: int = 20,
+    *,
+    start: int = 0,
+    stop: Optional[int] = None,
+    seed: Optional[int] = None,
+    use_templates: bool = True,
+    max_retries: int = 10
+) -> Iterator[tuple[str, str]]:
     """
-    Generate lexical items for a given prompt, enforcing a strict JSON schema.
-    Returns a dict mapping each field name to its list of generated strings.
+    Lazily generate premise/hypothesis pairs. The premise and the hypothesis are the yields of the
+    PREMISE and HYPOTHESIS subtrees of each derivation, joined separately: no marker token is needed
+    in the grammar, nor searched in the sentences. See sample_yields for the sampling options.
+    """
+
+    for label in (PREMISE, HYPOTHESIS):
+        if label not in grammar.mappings:
+            raise ValueError(f"The grammar has no {label} non-terminal to generate pairs from")
+
+    if stop is None:
+        stop = start + num_examples
+
+    for sides in sample_yields(grammar, start, stop, seed, False, use_templates, max_retries, spans=(PREMISE, HYPOTHESIS)):
+        profiler.count("examples generated")
+        with profiler.timer("detokenize"):
+            pair = grammar.detokenizer.join(sides[PREMISE]), grammar.detokenizer.join(sides[HYPOTHESIS])
+        yield pair
+
+
+def build_schema(k: int, field_names: List[str]) -> tuple[Any, Dict[str, Any]]:
+    """
+    Build the pydantic model and the strict JSON schema for a request of k items per field.
+    Returns the model class (used for validation) and its JSON schema (sent to the model).
     """
 
     # Define the format fields (they correspond to the entry labels, i.e. the non-terminals)
@@ -52,23 +161,70 @@ def generate_items(prompt: str,  k: int, field_names: List[str], model: str = 'm
     json_schema = SchemaClass.model_json_schema()
     json_schema["additionalProperties"] = False
 
+    return SchemaClass, json_schema
+
+
+def build_messages(prompt: str, k: int) -> List[Dict[str, str]]:
+    """Prepare the system and user messages for the ollama chat API."""
+
     # System general prompt
     system_prompts = (
         f'You are a JSON generator. You must output only valid JSON that conforms exactly to the provided schema. '
         f'You will receive an instruction to “Generate exactly {k} items.” You must return exactly {k} elements in each list. '
     )
 
-    # Prepare the system and user messages for the ollama chat API
     system_msg = {'role': 'system', 'content': system_prompts}
     user_msg = {'role': 'user', 'content': prompt}
 
+    return [system_msg, user_msg]
+
+
+def validate_items(content: str, SchemaClass: Any, k: int) -> Dict[str, List[str]]:
+    """Validate a JSON model response against the schema and return the lists of items."""
+
+    if not content:
+        raise ValueError("No content in model response")
+
+    # Validate the JSON response against our schema
+    try:
+        instance = SchemaClass.model_validate_json(content)
+    except Exception as e:
+        raise ValueError("Output format was not validated") from e
+
+    # Enforce exact length for each field
+    data = instance.model_dump()
+    for field, items in data.items():
+        if len(items) != k:
+            raise ValueError(f"{field}: expected {k} items, got {len(items)}")
+
+    return data
+
+
+def generate_items(prompt: str,  k: int, field_names: List[str], model: str = 'mistral', seed: Optional[int] = None, cache: Optional[ResponseCache] = None) -> Dict[str, List[str]]:
+    """
+    Generate lexical items for a given prompt, enforcing a strict JSON schema.
+    Returns a dict mapping each field name to its list of generated strings.
+    Validated outputs are stored in (and served from) the cache when one is provided.
+    """
+
+    SchemaClass, json_schema = build_schema(k, field_names)
+    messages = build_messages(prompt, k)
+
+    # Serve the request from the cache if possible
+    if cache is not None:
+        cache_key = cache.key(model, messages, json_schema, seed)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     start = time.time()
 
     # Streaming call
     response = chat(
-        messages=[system_msg, user_msg],
+        messages=messages,
         model=model,
         format=json_schema,
+        options={'seed': seed} if seed is not None else None,
         stream=True,
     )
 
@@ -83,25 +239,172 @@ def generate_items(prompt: str,  k: int, field_names: List[str], model: str = 'm
     elapsed = time.time() - start
     print(f"Generation took {elapsed:.2f}s")
 
-    content = "".join(chunks)
-    if not content:
-        raise ValueError("No content in model response")
+    data = validate_items("".join(chunks), SchemaClass, k)
 
-    # Validate the JSON response against our schema
-    try:
-        instance = SchemaClass.model_validate_json(content)
-    except Exception as e:
-        raise ValueError("Output format was not validated") from e
+    if cache is not None:
+        cache.put(cache_key, data)
 
-    # Enforce exact length for each field
-    data = instance.model_dump()
-    for field, items in data.items():
-        if len(items) != k:
-            raise ValueError(f"{field}: expected {k} items, got {len(items)}")
+    return data
+
+
+async def agenerate_items(client: AsyncClient, prompt: str, k: int, field_names: List[str], model: str = 'mistral', seed: Optional[int] = None, cache: Optional[ResponseCache] = None, ordinal: int = 0) -> Dict[str, List[str]]:
+    """
+    Asynchronous counterpart of generate_items, issued through an ollama AsyncClient.
+    The ordinal numbers successive requests sharing the same prompt, so they are cached separately.
+    """
+
+    SchemaClass, json_schema = build_schema(k, field_names)
+    messages = build_messages(prompt, k)
+
+    # Serve the request from the cache if possible
+    if cache is not None:
+        cache_key = cache.key(model, messages, json_schema, seed, ordinal)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    response = await client.chat(
+        messages=messages,
+        model=model,
+        format=json_schema,
+        options={'seed': seed + ordinal} if seed is not None else None,
+    )
+
+    data = validate_items(response["message"]["content"], SchemaClass, k)
+
+    if cache is not None:
+        cache.put(cache_key, data)
 
     return data
 
 
+def split_count(k: int, chunk_size: Optional[int]) -> List[int]:
+    """Split a number of items into request sizes of at most chunk_size (no split if None)."""
+
+    if not chunk_size or k <= chunk_size:
+        return [k]
+
+    return [chunk_size] * (k // chunk_size) + ([k % chunk_size] if k % chunk_size else [])
+
+
+async def agenerate_lexicon(prompts: Dict[str, Dict[str, List[str]]], k: int, model: str = 'mistral', concurrency: int = 4, chunk_size: Optional[int] = 50, max_retries: int = 3, seed: Optional[int] = None, cache: Optional[ResponseCache] = None) -> Dict[str, List[str]]:
+    """
+    Generate k unique lexical items for each prompt concurrently.
+    Each prompt is generated in chunks of at most chunk_size items, and at most
+    `concurrency` requests are sent to the ollama server at the same time.
+    Every chunk is validated on its own: a failed chunk (invalid output, server or connection error)
+    is requested again instead of discarding the whole generation, and items already seen in previous
+    chunks are dropped, until k unique items are accumulated. The fields of prompts marked "linked"
+    in prompts.json are forms of the same entries (e.g. the V_INF and V_3SG of a verb) and are
+    deduplicated together on their first field; the other fields are independent lists, deduplicated one by one.
+    Returns a dict mapping each field name to its merged list of items.
+
+    -   prompts (Dict): maps each prompt label to its entry in prompts.json ("labels" and "prompt" template).
+    -   k (int): the number of items to generate for each prompt.
+    -   model (str): the ollama model name.
+    -   concurrency (int): the maximum number of simultaneous requests.
+    -   chunk_size (Optional[int]): the maximum number of items per request (default: 50, None for no split).
+    -   max_retries (int): the number of failed or unproductive chunks tolerated per prompt (default: 3).
+    -   seed (Optional[int]): the base sampling seed, offset by the request ordinal for each chunk.
+    -   cache (Optional[ResponseCache]): the cache of validated outputs (default: no caching).
+    """
+
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Number of requests issued so far for each prompt
+    ordinals = {label: 0 for label in prompts}
+
+    async def request(label: str, size: int) -> Optional[Dict[str, List[str]]]:
+        prompt = "\n".join(prompts[label]["prompt"]).format(k=size)
+        ordinal = ordinals[label]
+        ordinals[label] += 1
+        async with semaphore:
+            try:
+                return await agenerate_items(client, prompt, size, prompts[label]["labels"], model, seed, cache, ordinal)
+            except (ValueError, ResponseError, RequestError, ConnectionError, httpx.HTTPError) as e:
+                print(f"[WARNING] Chunk of {size} items for '{label}' was rejected: {e}")
+                return None
+
+    async def collect(label: str, pbar) -> Dict[str, List[str]]:
+        field_names = prompts[label]["labels"]
+        linked = prompts[label].get("linked", False)
+        items: Dict[str, List[str]] = {name: [] for name in field_names}
+        seen: Dict[str, set] = {name: set() for name in field_names}
+        failures = 0
+
+        def count() -> int:
+            return min(len(items[name]) for name in field_names)
+
+        # Request the missing items until k unique items are accumulated in every field
+        while count() < k:
+            chunks = await asyncio.gather(*(request(label, size) for size in split_count(k - count(), chunk_size)))
+
+            for chunk in chunks:
+
+                # Invalid chunks are simply requested again in the next round
+                if chunk is None:
+                    failures += 1
+                    continue
+
+                before = count()
+                added = 0
+
+                # Linked forms are deduplicated as entries on their first field (e.g. the infinitive of a verb)
+                if linked:
+                    first = field_names[0]
+                    for entry in zip(*(chunk[name] for name in field_names)):
+                        key = entry[0].strip().lower()
+                        if key in seen[first] or len(items[first]) == k:
+                            continue
+                        seen[first].add(key)
+                        for name, item in zip(field_names, entry):
+                            items[name].append(item)
+                        added += 1
+
+                # Independent lists (e.g. nouns and adjectives) are deduplicated field by field
+                else:
+                    for name in field_names:
+                        for item in chunk[name]:
+                            key = item.strip().lower()
+                            if key in seen[name] or len(items[name]) == k:
+                                continue
+                            seen[name].add(key)
+                            items[name].append(item)
+                            added += 1
+
+                # A chunk made only of duplicates counts as a failure
+                if not added and count() < k:
+                    failures += 1
+                pbar.update(count() - before)
+
+            if failures > max_retries:
+                raise ValueError(f"{label}: gave up after {failures} failed chunks ({count()}/{k} unique items)")
+
+        return items
+
+    start = time.time()
+    with tqdm(total=k * len(prompts), desc="Generating", unit="item") as pbar:
+        results = await asyncio.gather(*(collect(label, pbar) for label in prompts))
+
+    elapsed = time.time() - start
+    print(f"Generation took {elapsed:.2f}s")
+
+    # Merge the fields of every prompt
+    output: Dict[str, List[str]] = {}
+    for result in results:
+        output.update(result)
+
+    return output
+
+
+@profiler.timed("generate_lexicon")
+def generate_lexicon(prompts: Dict[str, Dict[str, List[str]]], k: int, model: str = 'mistral', concurrency: int = 4, chunk_size: Optional[int] = 50, max_retries: int = 3, seed: Optional[int] = None, cache: Optional[ResponseCache] = None) -> Dict[str, List[str]]:
+    """Synchronous entry point for agenerate_lexicon."""
+
+    return asyncio.run(agenerate_lexicon(prompts, k, model, concurrency, chunk_size, max_retries, seed, cache))
+
+
 def format_rules(slot_dict: Dict[str, List[str]]) -> Dict[str, List[Rule]]:
     """
     Convert a slot-mapped dict into CFG Rule objects.
@@ -126,21 +429,3 @@ def format_rules(slot_dict: Dict[str, List[str]]) -> Dict[str, List[Rule]]:
 
     # Return the mapping of slot labels to rule string lists
     return rules_map
-
-
-def format_examples(input: Dict[str, List[str]]) -> Dict[str, List[tuple[str, str]]]:
-    """Format examples as premise/hypothesis tuples."""
-
-    formatted_examples: Dict[str, List[tuple[str, str]]] = {}
-
-    for grammar, examples in input.items():
-        formatted_examples[grammar] = []
-
-        for example in examples:
-            if "[H]" in example:
-                premise, hypothesis = example.split("[H]", 1)
-                premise = premise.replace("[P]", "", 1).strip()
-                hypothesis = hypothesis.strip()
-                formatted_examples[grammar].append((premise, hypothesis))
-    
-    return formatted_examples
\ No newline at end of file
@@ -0,0 +1,221 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import List, Dict, Any, Iterable, Iterator, Optional
+from source.cfg_utils import Rule
+from source.paths import RULES_DIR
+
+
+def store_path(name: str) -> Path:
+    """Path of the lexicon store saved under a name in data/rules/ (the .db suffix is added if the name has none)."""
+
+    path = RULES_DIR / name
+
+    return path if path.suffix else path.with_suffix(".db")
+
+
+class Lexicon:
+    """
+    Class for a pool of lexical rules grouped by category (e.g., "NP", "V_INF"),
+    built once and shared by all the grammars that use it.
+    The lexicon is immutable: its rules are copied at construction and never modified afterwards
+    (grammars normalize probabilities in their own views, see CFG), so populating a grammar
+    only costs references to the rules of the categories it uses.
+    """
+
+    def __init__(self, rules: Dict[str, List[Rule]]) -> None:
+        """
+        Initialize the lexicon with the lexical rules of each category.
+        Duplicate rules (same left and right sides) are only kept once.
+
+        -   rules (Dict[str, List[Rule]]): the lexical rules grouped by category.
+        -   categories (Dict[str, tuple[Rule, ...]]): the (copied) rules of each category, in their original order.
+        """
+
+        self.categories: Dict[str, tuple[Rule, ...]] = {}
+
+        for category, rules_list in rules.items():
+            unique = dict.fromkeys(Rule(rule.left, list(rule.right), rule.prob, dict(rule.features)) for rule in rules_list)
+            self.categories[category] = tuple(unique)
+
+    def rules(self, categories: Iterable[str]) -> List[Rule]:
+        """Return the rules of the given categories (unknown categories are ignored), without duplicates."""
+
+        selected: Dict[Rule, None] = {}
+
+        for category in categories:
+            selected.update(dict.fromkeys(self.categories.get(category, ())))
+
+        return list(selected)
+
+    def __getitem__(self, category: str) -> tuple[Rule, ...]:
+        """Return the rules of a category."""
+
+        return self.categories[category]
+
+    def __contains__(self, category: str) -> bool:
+        """Check if the lexicon has rules for a category."""
+
+        return category in self.categories
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over the categories."""
+
+        return iter(self.categories)
+
+    def __len__(self) -> int:
+        """Total number of lexical rules."""
+
+        return sum(len(rules) for rules in self.categories.values())
+
+
+class LexiconStore:
+    """
+    Class for the on-disk store of generated lexical items (a SQLite database).
+    Each entry is a record holding all the linked forms of an item (e.g., the V_INF and V_3SG forms of a verb),
+    so forms never have to be aligned by position; items of independent lists (e.g., nouns and adjectives)
+    are entries of a single form. Entries are deduplicated on insert and appended without rewriting the store,
+    and the forms can be queried by category.
+    """
+
+    def __init__(self, path: Path, readonly: bool = False) -> None:
+        """
+        Open the store, creating it if needed (a read-only store must exist).
+        Raises FileNotFoundError for a missing read-only store, and sqlite3.DatabaseError if the file is not a database.
+
+        -   path (Path): the SQLite database file.
+        -   readonly (bool): open an existing store without ever writing to it.
+        -   connection (sqlite3.Connection): the connection to the database.
+        """
+
+        self.path: Path = Path(path)
+
+        if readonly:
+            if not self.path.is_file():
+                raise FileNotFoundError(f"No lexicon store at {self.path}")
+            self.connection: sqlite3.Connection = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri=True)
+            self.connection.execute("SELECT COUNT(*) FROM entries")
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "id INTEGER PRIMARY KEY, prompt TEXT NOT NULL, field TEXT NOT NULL, key TEXT NOT NULL, "
+                "UNIQUE (prompt, field, key))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS forms ("
+                "entry INTEGER NOT NULL REFERENCES entries (id), category TEXT NOT NULL, form TEXT NOT NULL, "
+                "PRIMARY KEY (entry, category))"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS forms_category ON forms (category, entry)")
+
+    def add(self, prompt: str, fields: Dict[str, List[str]], linked: bool = False) -> int:
+        """
+        Insert the items generated for a prompt. Entries are keyed by their form (stripped and lowercased,
+        as in generate_lexicon): entries already in the store for the same prompt and field are skipped.
+        Returns the number of new entries.
+
+        -   prompt (str): the prompt label (e.g., "Verbs").
+        -   fields (Dict[str, List[str]]): the generated items of each field (e.g., "V_INF" and "V_3SG").
+        -   linked (bool): the i-th item of each field are the forms of the i-th entry, keyed by its first form
+            (prompts marked "linked" in prompts.json); otherwise every item is an entry of its own field.
+        """
+
+        if linked:
+            first = next(iter(fields))
+            rows = [(first, dict(zip(fields, forms))) for forms in zip(*fields.values())]
+        else:
+            rows = [(category, {category: form}) for category, forms in fields.items() for form in forms]
+
+        added = 0
+
+        with self.connection:
+            for field, forms in rows:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO entries (prompt, field, key) VALUES (?, ?, ?)",
+                    (prompt, field, forms[field].strip().lower())
+                )
+                if not cursor.rowcount:
+                    continue
+
+                self.connection.executemany(
+                    "INSERT INTO forms (entry, category, form) VALUES (?, ?, ?)",
+                    [(cursor.lastrowid, category, form) for category, form in forms.items()]
+                )
+                added += 1
+
+        return added
+
+    def import_json(self, path: Path, prompts: Dict[str, Dict[str, Any]]) -> int:
+        """
+        Import a JSON rule file (the former --generate-rules --save format, mapping each category to its forms).
+        The categories are grouped by the prompt of prompts.json generating them, and the forms of linked prompts
+        are aligned by position; categories of no prompt are imported as prompts of their own.
+        Category names are kept as stored (e.g., "N" for the Nouns prompt). Returns the number of new entries.
+
+        -   path (Path): the JSON rule file.
+        -   prompts (Dict): the prompts of prompts.json ("labels" and optional "linked" flag of each prompt).
+        """
+
+        with open(path, "r", encoding="utf-8") as f:
+            data: Dict[str, List[str]] = json.load(f)
+
+        added = 0
+
+        for label, prompt in prompts.items():
+            fields = {name: data.pop(name) for name in prompt["labels"] if name in data}
+            if fields:
+                added += self.add(label, fields, prompt.get("linked", False))
+
+        for category, forms in data.items():
+            added += self.add(category, {category: forms})
+
+        return added
+
+    def forms(self, category: str) -> List[str]:
+        """Return the forms of a category, in insertion order."""
+
+        rows = self.connection.execute("SELECT form FROM forms WHERE category = ? ORDER BY entry", (category,))
+
+        return [form for form, in rows]
+
+    def categories(self) -> List[str]:
+        """Return the categories of the store, in order of first insertion."""
+
+        rows = self.connection.execute("SELECT category FROM forms GROUP BY category ORDER BY MIN(rowid)")
+
+        return [category for category, in rows]
+
+    def items(self) -> Dict[str, List[str]]:
+        """Return the forms of every category, in the format of format_rules (and of the former JSON rule files)."""
+
+        return {category: self.forms(category) for category in self.categories()}
+
+    def entries(self, prompt: Optional[str] = None) -> List[Dict[str, str]]:
+        """Return the entries (of a prompt, or all of them) as dicts of linked forms by category, in insertion order."""
+
+        query = "SELECT forms.entry, forms.category, forms.form FROM forms JOIN entries ON entries.id = forms.entry"
+        parameters: tuple = ()
+        if prompt is not None:
+            query += " WHERE entries.prompt = ?"
+            parameters = (prompt,)
+
+        entries: Dict[int, Dict[str, str]] = {}
+        for entry, category, form in self.connection.execute(query + " ORDER BY forms.entry, forms.rowid", parameters):
+            entries.setdefault(entry, {})[category] = form
+
+        return list(entries.values())
+
+    def __len__(self) -> int:
+        """Number of entries."""
+
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self) -> None:
+        """Close the connection to the database."""
+
+        self.connection.close()
@@ -0,0 +1,146 @@
+import torch
+import numpy as np
+import onnxruntime as ort
+from pathlib import Path
+from types import SimpleNamespace
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+from source.paths import RESULTS_DIR
+
+# Exported models are cached next to the results
+ONNX_DIR = RESULTS_DIR / "onnx"
+
+# Largest accepted difference between torch and onnxruntime logits
+PARITY_TOLERANCE = 1e-3
+
+
+class LogitsOnly(torch.nn.Module):
+    """Module returning only the logits of a sequence classification model, with positional inputs for export."""
+
+    def __init__(self, model, input_names) -> None:
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs))).logits
+
+
+class OnnxNLIModel:
+    """Class exposing an onnxruntime session through the part of the torch model interface used by evaluate."""
+
+    def __init__(self, path: Path, config) -> None:
+        """
+        Create an optimized CPU inference session for an exported model.
+
+        - path (Path): the .onnx file.
+        - config (PretrainedConfig): the model configuration (used for id2label).
+        """
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.config = config
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+
+    def eval(self) -> "OnnxNLIModel":
+        return self
+
+    def __call__(self, **inputs):
+        """Run the session on tokenizer outputs and return an object with torch logits, like the torch model."""
+
+        feeds = {name: inputs[name].numpy().astype(np.int64) for name in self.input_names}
+        logits = self.session.run(["logits"], feeds)[0]
+
+        return SimpleNamespace(logits=torch.from_numpy(logits))
+
+
+def onnx_path(model_name: str) -> Path:
+    """Path of the cached ONNX export of a model."""
+
+    return ONNX_DIR / f"{model_name.replace('/', '__')}.onnx"
+
+
+def export_onnx(model_name: str, tokenizer, model, path: Path) -> None:
+    """Export a torch sequence classification model to ONNX, with dynamic batch and sequence axes."""
+
+    sample = tokenizer(["The boy sleeps."], ["The boy is permitted to sleep."], return_tensors="pt")
+    input_names = [name for name in tokenizer.model_input_names if name in sample]
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    print(f"Exporting {model_name} to {path}")
+
+    # New modules start in training mode: export the wrapper in inference mode (no dropout)
+    torch.onnx.export(
+        LogitsOnly(model, input_names).eval(),
+        tuple(sample[name] for name in input_names),
+        str(path),
+        input_names=input_names,
+        output_names=["logits"],
+        dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in input_names}, "logits": {0: "batch"}},
+        opset_version=17,
+    )
+
+
+def check_parity(tokenizer, torch_model, onnx_model, tolerance: float = PARITY_TOLERANCE) -> float:
+    """
+    Compare torch and onnxruntime logits on a sample batch of pairs of different lengths.
+    Returns the largest absolute difference, and raises if it exceeds the tolerance.
+    """
+
+    premises = ["The boy sleeps or runs.", "It is not the case that my sister is permitted to swim."]
+    hypotheses = ["The boy sleeps.", "My sister is permitted to swim and is forbidden to dance."]
+    inputs = tokenizer(premises, hypotheses, return_tensors="pt", padding=True, truncation=True)
+
+    with torch.inference_mode():
+        expected = torch_model(**inputs).logits
+    actual = onnx_model(**inputs).logits
+
+    difference = float((expected - actual).abs().max())
+    if difference > tolerance:
+        raise ValueError(f"ONNX logits differ from torch logits by {difference:.2e} (tolerance {tolerance:.0e})")
+
+    print(f"ONNX parity check passed (max logit difference {difference:.2e})")
+
+    return difference
+
+
+def load_onnx_model(model_name: str, parity: bool = False):
+    """
+    Load a tokenizer and an onnxruntime NLI model, exporting the torch checkpoint on first use.
+    The parity check against the torch logits runs after each export, or on every load with parity=True.
+
+    - model_name (str): the model name taken from HuggingFace.
+    - parity (bool): check the logits against the torch model even when the export is cached.
+    """
+
+    path = onnx_path(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    # The torch model is only needed to export and to check parity
+    if not path.exists() or parity:
+        torch_model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        torch_model.eval()
+
+        exported = not path.exists()
+        if exported:
+            export_onnx(model_name, tokenizer, torch_model, path)
+
+            # The exporter restores the training mode of the modules it traced
+            torch_model.eval()
+
+        model = OnnxNLIModel(path, torch_model.config)
+
+        # A failed export is not cached, so the next run exports (and checks) again
+        try:
+            check_parity(tokenizer, torch_model, model)
+        except ValueError:
+            if exported:
+                path.unlink()
+            raise
+
+        del torch_model
+
+        return tokenizer, model
+
+    return tokenizer, OnnxNLIModel(path, AutoConfig.from_pretrained(model_name))
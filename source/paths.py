@@ -7,4 +7,5 @@ EXAMPLES_DIR = DATA_DIR / "examples"
 RULES_DIR = DATA_DIR / "rules"
 RESULTS_DIR = PROJECT_ROOT / "results"
 GRAMMARS_DIR = PROJECT_ROOT / "grammars"
-PROMPTS_PATH = DATA_DIR / "prompts.json"
\ No newline at end of file
+PROMPTS_PATH = DATA_DIR / "prompts.json"
+CACHE_DIR = PROJECT_ROOT / "cache"
\ No newline at end of file
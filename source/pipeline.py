@@ -0,0 +1,124 @@
+import json
+import queue
+import threading
+import numpy as np
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+from source.cfg import CFG
+from source.generate import generate_pairs
+from source.evaluate import Results, load_nli_model, label_order, evaluate
+from source.profiling import profiler
+
+# Marker put in the queue once all the pairs of a grammar are generated
+END_OF_GRAMMAR = None
+
+
+def produce_pairs(
+    grammars: Dict[str, CFG],
+    pairs_queue: queue.Queue,
+    num_examples: int,
+    start: int = 0,
+    seed: Optional[int] = None,
+    max_retries: int = 10,
+    tee_path: Optional[Path] = None
+) -> None:
+    """
+    Generate the pairs of each grammar into a queue, as (name, pair) items followed by (name, END_OF_GRAMMAR).
+    If generation fails, the exception is put in the queue to be raised by the consumer.
+
+    - grammars (Dict[str, CFG]): the grammars, by name.
+    - pairs_queue (queue.Queue): the queue read by the evaluation loop.
+    - num_examples, start, seed, max_retries: see generate_pairs.
+    - tee_path (Optional[Path]): if given, the pairs are also written there as JSON lines.
+    """
+
+    tee = open(tee_path, "w", encoding="utf-8") if tee_path is not None else None
+
+    try:
+        for name, grammar in grammars.items():
+            for premise, hypothesis in generate_pairs(grammar, num_examples, start=start, seed=seed, max_retries=max_retries):
+                pairs_queue.put((name, (premise, hypothesis)))
+
+                if tee is not None:
+                    tee.write(json.dumps({"grammar": name, "premise": premise, "hypothesis": hypothesis}, ensure_ascii=False) + "\n")
+
+            pairs_queue.put((name, END_OF_GRAMMAR))
+
+    except Exception as error:
+        pairs_queue.put(error)
+
+    finally:
+        if tee is not None:
+            tee.close()
+
+
+def stream_evaluate(
+    grammars: Dict[str, CFG],
+    model_name: str,
+    num_examples: int,
+    batch_size: int = 16,
+    backend: str = "torch",
+    start: int = 0,
+    seed: Optional[int] = None,
+    max_retries: int = 10,
+    tee_path: Optional[Path] = None
+) -> Iterator[tuple[str, Results, list]]:
+    """
+    Fused generation and evaluation: pairs are generated in a background thread and evaluated
+    batch by batch as they arrive, without going through a JSON file. The model is loaded while
+    the first pairs are being generated. Yields (name, results, classes) for each grammar once
+    all its pairs are evaluated.
+
+    - grammars (Dict[str, CFG]): the grammars, by name.
+    - model_name (str): the HuggingFace model name.
+    - num_examples (int): the number of pairs per grammar.
+    - batch_size (int): the number of pairs per forward pass.
+    - backend (str): the inference backend, "torch" or "onnx".
+    - start, seed, max_retries: see generate_pairs.
+    - tee_path (Optional[Path]): if given, the generated pairs are also written there as JSON lines.
+    """
+
+    # Bounded queue: generation runs ahead of inference by a few batches at most
+    pairs_queue: queue.Queue = queue.Queue(maxsize=4 * batch_size)
+    producer = threading.Thread(
+        target=produce_pairs,
+        args=(grammars, pairs_queue, num_examples, start, seed, max_retries, tee_path),
+        daemon=True
+    )
+    producer.start()
+
+    loaded = load_nli_model(model_name, backend=backend)
+    _, classes = label_order(loaded[1].config.id2label)
+
+    batch = []
+    probs = []
+    pairs = []
+    remaining = len(grammars)
+
+    while remaining:
+        with profiler.timer("pipeline.wait"):
+            item = pairs_queue.get()
+
+        if isinstance(item, Exception):
+            raise item
+
+        name, pair = item
+
+        if pair is not END_OF_GRAMMAR:
+            batch.append(pair)
+
+        # Evaluate full batches, and the last partial batch of each grammar
+        if len(batch) == batch_size or (pair is END_OF_GRAMMAR and batch):
+            results, _ = evaluate(batch, model_name, batch_size, loaded)
+            probs.append(results.probs)
+            pairs.extend(batch)
+            batch = []
+
+        if pair is END_OF_GRAMMAR:
+            grammar_probs = np.concatenate(probs) if probs else np.zeros((0, len(classes)))
+            yield name, Results(pairs, grammar_probs, classes), classes
+            probs = []
+            pairs = []
+            remaining -= 1
+
+    producer.join()
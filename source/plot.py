@@ -0,0 +1,193 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.patches as mpatches
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.ticker import MaxNLocator
+from source.profiling import profiler
+
+# Plots are only saved to files: use the non-interactive backend (also in worker processes)
+matplotlib.use("Agg")
+
+# Above this number of examples, per-example stacked bars are replaced by aggregated views
+MAX_BARS = 500
+
+# Largest number of worker processes rendering plots in parallel
+MAX_WORKERS = 4
+
+
+@profiler.timed("plot")
+def plot_bar(probs, classes, base_dir, key_name, max_bars=MAX_BARS):
+    """
+    Helper function to plot model's output for each example.
+    Above max_bars examples, one bar per example is unreadable and slow to render,
+    so the plot switches to aggregated views: the distribution of each class probability
+    and the stacked probabilities of all examples sorted by predicted class and confidence.
+    
+    - probs (List[List[float]] | np.ndarray): the probability for each class, for each example.
+    - classes (List[str]): the classes (output labels).
+    - base_dir: (str): directory to save plot
+    - max_bars (int): the largest number of examples plotted as individual bars.
+    """
+
+    # Path to store the figure
+    path = os.path.join(base_dir, f"graph_{key_name}.png")
+    print(f"Saving plot to {path}")
+
+    probs = np.asarray(probs, dtype=float).reshape(-1, len(classes))
+    num_examples = len(probs)
+
+    if num_examples <= max_bars:
+
+        # Stacked bars: each class starts where the previous ones end
+        figure, axis = plt.subplots()
+        bottoms = np.cumsum(probs, axis=1) - probs
+        ids = np.arange(num_examples)
+        for i, cls in enumerate(classes):
+            axis.bar(ids, probs[:, i], bottom=bottoms[:, i], width=0.5, label=cls)
+        axis.set(title=key_name, xlabel="Example IDs", ylabel="Probabilities")
+        axis.xaxis.set_major_locator(MaxNLocator(nbins=20, integer=True))
+        axis.legend()
+
+    else:
+        figure, (hist_axis, area_axis) = plt.subplots(1, 2, figsize=(12, 4.5))
+
+        # Binned distribution of the probability of each class
+        bins = np.linspace(0.0, 1.0, 51)
+        for i, cls in enumerate(classes):
+            counts, _ = np.histogram(probs[:, i], bins=bins)
+            hist_axis.stairs(counts, bins, label=cls)
+        hist_axis.set(title=f"{key_name} (n={num_examples})", xlabel="Probability", ylabel="Examples")
+        hist_axis.set_yscale("symlog")
+        hist_axis.legend()
+
+        # Examples sorted by predicted class, then by decreasing confidence
+        predicted = probs.argmax(axis=1)
+        order = np.lexsort((-probs.max(axis=1), predicted))
+        area_axis.stackplot(np.arange(num_examples), probs[order].T, labels=classes)
+        area_axis.set(title="Sorted class probabilities", xlabel="Examples (sorted)", ylabel="Probabilities")
+        area_axis.set_xlim(0, num_examples - 1)
+        area_axis.set_ylim(0, 1)
+
+    # Save
+    figure.tight_layout()
+    figure.savefig(path, dpi=300)
+    plt.close(figure)
+
+
+def plot_all(probs_by_key, classes, base_dir, workers=None):
+    """
+    Render the plots of several grammar keys in parallel worker processes.
+    Workers are forked from a fork server that only preloads this module (not from a process that may hold torch
+    and its threads), and the rendering is timed in this process, since the timings of the workers are lost.
+
+    - probs_by_key (Dict[str, np.ndarray]): the probabilities of each grammar key.
+    - classes (List[str]): the classes (output labels).
+    - base_dir (str): directory to save plots.
+    - workers (Optional[int]): number of worker processes (default: one per key and per CPU, at most MAX_WORKERS).
+    """
+
+    if workers is None:
+        workers = min(len(probs_by_key), os.cpu_count() or 1, MAX_WORKERS)
+
+    if len(probs_by_key) <= 1 or workers == 1:
+        for key_name, probs in probs_by_key.items():
+            plot_bar(probs, classes, base_dir, key_name)
+        return
+
+    # Fork servers are not available on every platform (e.g. Windows): spawn the workers there
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["source.plot"])
+    else:
+        context = multiprocessing.get_context("spawn")
+
+    with profiler.timer("plot"), ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = [
+            executor.submit(plot_bar, np.asarray(probs, dtype=float), classes, base_dir, key_name)
+            for key_name, probs in probs_by_key.items()
+        ]
+
+        # Surface any rendering error
+        for future in futures:
+            future.result()
+
+
+@profiler.timed("plot")
+def plot_mustache(all_entropies, results_dir):
+    """Helper function to plot model output distributions for each grammar across all examples."""
+
+    # Set path
+    path = os.path.join(results_dir, "cross_grammar_entropy_boxplot.png")
+    print(f"Saving mustache plot to {path}")
+
+    # One array of entropies per grammar, numbered for the x-axis
+    names = list(all_entropies)
+    data = [np.asarray(all_entropies[name], dtype=float) for name in names]
+    index_map = {i + 1: name for i, name in enumerate(names)}
+
+    # Create boxplot
+    figure, axis = plt.subplots()
+    axis.boxplot(data, patch_artist=True)
+    axis.set(title="Cross-Grammar Entropy", xlabel="Sub-grammars", ylabel="Entropy (bits)")
+
+    # Add legend using the mapping
+    legend_patches = [mpatches.Patch(label=f"{i}: {name}") for i, name in index_map.items()]
+    axis.legend(
+        handles=legend_patches,
+        title="Legend",
+        loc="center right",
+        bbox_to_anchor=(-0.115, 0.5),
+        fontsize="small"
+    )
+
+    # Save plot
+    figure.savefig(path, bbox_inches="tight", dpi=300)
+    plt.close(figure)
+
+
+def load_results(results_dir):
+    """
+    Load the results persisted by write_to_file.
+    Returns the probabilities of each grammar key and the classes.
+    """
+
+    probs_by_key = {}
+    classes = None
+
+    for path in sorted(glob(os.path.join(results_dir, "results_*.json"))):
+        key_name = os.path.basename(path)[len("results_"):-len(".json")]
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        probs_by_key[key_name] = np.asarray(data["probs"], dtype=float)
+        classes = data["classes"]
+
+    return probs_by_key, classes
+
+
+def plot_results(results_dir, workers=None):
+    """
+    Render all plots from the results persisted in a directory (per-key results and entropies),
+    and in its per-model sub-directories.
+    """
+
+    found = False
+
+    for directory in [results_dir] + sorted(glob(os.path.join(results_dir, "*", ""))):
+        probs_by_key, classes = load_results(directory)
+        if probs_by_key:
+            plot_all(probs_by_key, classes, directory, workers)
+            found = True
+
+        entropies_path = os.path.join(directory, "entropies.json")
+        if os.path.exists(entropies_path):
+            with open(entropies_path, "r", encoding="utf-8") as f:
+                plot_mustache(json.load(f), directory)
+            found = True
+
+    if not found:
+        print(f"No persisted results found in {results_dir}")
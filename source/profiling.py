@@ -0,0 +1,134 @@
+import time
+import atexit
+import cProfile
+import functools
+from collections import defaultdict
+from typing import Callable, DefaultDict, Optional, Any
+
+
+class Timer:
+    """Context manager adding the time spent in its block to a profiler stage."""
+
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.profiler.timings[self.name] += time.perf_counter() - self.start
+        self.profiler.calls[self.name] += 1
+
+
+class NullTimer:
+    """Context manager doing nothing, returned while the profiler is disabled."""
+
+    def __enter__(self) -> "NullTimer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+class Profiler:
+    """Class for the lightweight per-stage timers and counters of the pipeline."""
+
+    def __init__(self) -> None:
+        """
+        Initialize a disabled profiler.
+
+        -   enabled (bool): whether timers and counters record anything.
+        -   timings (DefaultDict[str, float]): total seconds spent in each stage.
+        -   calls (DefaultDict[str, int]): number of times each stage was entered.
+        -   counters (DefaultDict[str, int]): free counters (examples generated, pairs evaluated, ...).
+        """
+
+        self.enabled: bool = False
+        self.timings: DefaultDict[str, float] = defaultdict(float)
+        self.calls: DefaultDict[str, int] = defaultdict(int)
+        self.counters: DefaultDict[str, int] = defaultdict(int)
+        self.null_timer = NullTimer()
+
+    def timer(self, name: str) -> Timer | NullTimer:
+        """Return a context manager timing a stage (a no-op while disabled)."""
+
+        if not self.enabled:
+            return self.null_timer
+
+        return Timer(self, name)
+
+    def timed(self, name: str) -> Callable:
+        """Decorator timing every call of a function as a stage."""
+
+        def decorator(function: Callable) -> Callable:
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs) -> Any:
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with Timer(self, name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def count(self, name: str, n: int = 1) -> None:
+        """Increment a counter (a no-op while disabled)."""
+
+        if self.enabled:
+            self.counters[name] += n
+
+    def reset(self) -> None:
+        """Clear all recorded timings and counters."""
+
+        self.timings.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    def report(self) -> str:
+        """Format the per-stage breakdown, slowest stages first."""
+
+        lines = [f"{'Stage':<28}{'Calls':>10}{'Total (s)':>12}{'Mean (ms)':>12}"]
+
+        for name, total in sorted(self.timings.items(), key=lambda item: item[1], reverse=True):
+            calls = self.calls[name]
+            lines.append(f"{name:<28}{calls:>10}{total:>12.3f}{1000 * total / calls:>12.3f}")
+
+        if self.counters:
+            lines.append("")
+            lines.extend(f"{name:<28}{value:>10}" for name, value in sorted(self.counters.items()))
+
+        return "\n".join(lines)
+
+
+# Shared profiler used across the source modules
+profiler = Profiler()
+
+
+def start_profiling(stats_path: Optional[str] = None) -> None:
+    """
+    Enable the shared profiler and print its report when the program exits.
+    If a path is given, the whole run is also profiled with cProfile and the stats are dumped there
+    (readable with pstats or snakeviz).
+    """
+
+    profiler.enabled = True
+
+    cprofile = None
+    if stats_path:
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+
+    def finish() -> None:
+        if cprofile is not None:
+            cprofile.disable()
+            cprofile.dump_stats(stats_path)
+            print(f"Saved cProfile stats to {stats_path}")
+
+        print("\n----Profile----\n")
+        print(profiler.report())
+
+    atexit.register(finish)
@@ -0,0 +1,198 @@
+import os
+import json
+import stat
+import time
+import socket
+import queue
+import threading
+import socketserver
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Tuple
+from source.evaluate import load_nli_model, evaluate
+
+
+class MicroBatcher:
+    """Class coalescing concurrent NLI requests into micro-batches for a resident model."""
+
+    def __init__(self, tokenizer, model, max_batch: int = 32, max_wait_ms: float = 10.0) -> None:
+        """
+        Start the batching thread.
+
+        - tokenizer, model: the loaded NLI tokenizer and model.
+        - max_batch (int): the largest number of pairs per forward pass.
+        - max_wait_ms (float): how long the first pair of a batch may wait for more pairs.
+        """
+
+        self.loaded = (tokenizer, model)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending: queue.Queue = queue.Queue()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, pairs: List[Tuple[str, str]]) -> List[Future]:
+        """Queue premise/hypothesis pairs and return one future per pair."""
+
+        futures = []
+        for pair in pairs:
+            future: Future = Future()
+            self.pending.put((pair, future))
+            futures.append(future)
+
+        return futures
+
+    def next_batch(self) -> List[Tuple[Tuple[str, str], Future]]:
+        """Wait for a first pair, then collect pairs until the batch is full or the latency budget is spent."""
+
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def run(self) -> None:
+        """Batching loop: evaluate each micro-batch and resolve the futures of its pairs."""
+
+        while True:
+            batch = self.next_batch()
+            pairs = [pair for pair, _ in batch]
+
+            try:
+                results, classes = evaluate(pairs, None, len(pairs), self.loaded)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            entropies = results.entropies()
+            for i, (_, future) in enumerate(batch):
+                future.set_result({
+                    "label": classes[results.pred_ids[i]],
+                    "probs": dict(zip(classes, results.probs[i].tolist())),
+                    "entropy": float(entropies[i]),
+                })
+
+
+class NLIRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP handler for NLI requests.
+    POST /nli with {"premise": ..., "hypothesis": ...} or {"pairs": [[premise, hypothesis], ...]}
+    returns {"results": [{"label": ..., "probs": {...}, "entropy": ...}, ...]}.
+    GET /health returns {"status": "ok"}.
+    """
+
+    batcher: MicroBatcher
+
+    def send_json(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        if self.path != "/nli":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        # Parse the pairs of the request
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if "pairs" in request:
+                pairs = [(str(premise), str(hypothesis)) for premise, hypothesis in request["pairs"]]
+            else:
+                pairs = [(str(request["premise"]), str(request["hypothesis"]))]
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        # Wait for the micro-batches containing the pairs
+        try:
+            results = [future.result() for future in self.batcher.submit(pairs)]
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+
+        self.send_json(200, {"results": results})
+
+    def address_string(self) -> str:
+        # Unix socket clients have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+class NLIHTTPServer(ThreadingHTTPServer):
+    """HTTP server listening on TCP, one thread per connection."""
+
+    # Accept bursts of concurrent clients (the default backlog is 5)
+    request_queue_size = 128
+
+
+class NLIUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket, one thread per connection."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(model_name: str, address: str = "127.0.0.1:8000", backend: str = "torch", max_batch: int = 32, max_wait_ms: float = 10.0) -> None:
+    """
+    Keep an NLI model resident and serve its judgements over HTTP until interrupted.
+
+    - model_name (str): the HuggingFace model name.
+    - address (str): "HOST:PORT" for TCP, or "unix:PATH" for a Unix socket.
+    - backend (str): the inference backend, "torch" or "onnx".
+    - max_batch (int): the largest number of pairs per forward pass.
+    - max_wait_ms (float): the latency budget for filling a micro-batch.
+    """
+
+    # Only a stale socket may be replaced (checked before loading the model)
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError(f"{path} exists and is not a socket")
+
+            # A socket still accepting connections belongs to a running server
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(path)
+                except ConnectionRefusedError:
+                    os.remove(path)
+                else:
+                    raise OSError(f"A server is already listening on {path}")
+
+    tokenizer, model = load_nli_model(model_name, backend)
+
+    handler = type("Handler", (NLIRequestHandler,), {"batcher": MicroBatcher(tokenizer, model, max_batch, max_wait_ms)})
+
+    if address.startswith("unix:"):
+        server = NLIUnixHTTPServer(path, handler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = NLIHTTPServer((host, int(port)), handler)
+
+    print(f"Serving {model_name} on {address} (POST /nli, GET /health)")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,645 @@
+import random
+from bisect import bisect
+from itertools import accumulate
+from typing import List, Dict, Any, Optional, Sequence, Set, TYPE_CHECKING
+from source.cfg_utils import Rule, DeadEndError, unify
+from source.profiling import profiler
+
+if TYPE_CHECKING:
+    from source.cfg import CFG
+
+# Limits of the analysis: beyond them, the grammar is left to the general engine
+MAX_TEMPLATES = 4096 # Largest number of templates a grammar is flattened into
+MAX_EXPANSIONS = 512 # Largest number of expansions in a single template (guards against recursive grammars)
+
+# Kinds of sampling steps
+RULE = 0 # A structural non-terminal with a single applicable rule
+SLOT = 1 # A lexical slot
+
+
+class NotFlattenable(Exception):
+    """Raised by the analysis when a grammar falls outside the template family."""
+
+
+class SlotValue:
+    """A feature value bound by a lexical slot, only known once the slot has been sampled."""
+
+    def __init__(self, slot: int, feature: str) -> None:
+        """
+        Initialize the reference to a feature of a slot.
+
+        -   slot (int): the index of the slot.
+        -   feature (str): the feature of the lexical rule selected for that slot.
+        """
+
+        self.slot: int = slot
+        self.feature: str = feature
+
+    def __eq__(self, other) -> bool:
+        """Two references are equal if they point to the same feature of the same slot."""
+
+        if not isinstance(other, SlotValue):
+            return NotImplemented
+
+        return (self.slot, self.feature) == (other.slot, other.feature)
+
+    def __hash__(self) -> int:
+        """Hash based on the slot and the feature."""
+
+        return hash((self.slot, self.feature))
+
+    def __repr__(self) -> str:
+        """Internal representation, e.g. <slot 0.verb>."""
+
+        return f"<slot {self.slot}.{self.feature}>"
+
+
+class Slot:
+    """Class for a lexical slot: a lexical non-terminal whose rule is drawn from a fixed array of lexical rules."""
+
+    def __init__(self, index: int, label: str, rules: List[Rule], weights: List[float], refs: Dict[str, SlotValue], constants: Dict[str, Any]) -> None:
+        """
+        Initialize the slot with the lexical rules that statically apply to it.
+
+        -   index (int): the index of the slot in the flattened grammar.
+        -   label (str): the lexical non-terminal (e.g., "NP", "V_INF").
+        -   rules (List[Rule]): the lexical rules compatible with the constant features of the slot, in grammar order.
+        -   weights (List[float]): the normalized probability of each of these rules in the grammar.
+        -   refs (Dict[str, SlotValue]): the features of the slot bound by earlier slots (e.g., the verb of an agreeing form).
+        -   constants (Dict[str, Any]): the constant features of the slot, which select its rules.
+        -   required (Set[str]): the features bound by later slots, which all the rules of the slot must define.
+        -   positions (Dict[Any, List[int]]): the positions of the rules for each value of the first bound feature.
+        -   unbound (List[int]): the positions of the rules without that feature, which match any value.
+        -   candidates (Dict[tuple, tuple]): the candidate positions and cumulative weights for each combination of bound values.
+        """
+
+        self.index: int = index
+        self.label: str = label
+        self.refs: Dict[str, SlotValue] = refs
+        self.constants: Dict[str, Any] = constants
+        self.required: Set[str] = set()
+        self.set_rules(rules, weights)
+
+    def set_rules(self, rules: List[Rule], weights: List[float]) -> None:
+        """Set the rules of the slot and their weights, and rebuild the indexes built on them."""
+
+        self.rules: List[Rule] = []
+        self.positions: Dict[Any, List[int]] = {}
+        self.unbound: List[int] = []
+        self.add_rules(rules, weights)
+
+    def add_rules(self, rules: List[Rule], weights: List[float]) -> None:
+        """
+        Append rules to the slot (following its rules in grammar order), index them, and reset the candidates.
+
+        -   rules (List[Rule]): the new rules.
+        -   weights (List[float]): the weights of all the rules of the slot, including the new ones.
+        """
+
+        start = len(self.rules)
+        self.rules.extend(rules)
+        self.weights: List[float] = weights
+        self.candidates: Dict[tuple, tuple[List[int], List[float]]] = {}
+
+        # Without bound features, the candidates never change
+        if not self.refs:
+            self.candidates[()] = (list(range(len(self.rules))), list(accumulate(weights)))
+
+        # Otherwise index the rules by the value of the first bound feature, so a lookup does not scan them all
+        else:
+            feature = next(iter(self.refs))
+            for position, rule in enumerate(rules, start):
+                if feature in rule.features:
+                    self.positions.setdefault(rule.features[feature], []).append(position)
+                else:
+                    self.unbound.append(position)
+
+    def lookup(self, chosen: List[Optional[Rule]]) -> tuple[List[int], List[float]]:
+        """
+        Return the positions of the candidate rules and their cumulative weights,
+        given the rules already chosen for earlier slots.
+        """
+
+        # Values bound by the earlier slots
+        bound = {feature: chosen[ref.slot].features[ref.feature] for feature, ref in self.refs.items()}
+        key = tuple(bound.values())
+
+        # Filter the rules once per combination of bound values, in grammar order
+        if key not in self.candidates:
+            positions = self.positions.get(key[0], [])
+            if self.unbound:
+                positions = sorted(positions + self.unbound)
+            if len(bound) > 1:
+                positions = [i for i in positions if unify(bound, self.rules[i].features) is not None]
+            self.candidates[key] = (positions, list(accumulate(self.weights[i] for i in positions)))
+
+        return self.candidates[key]
+
+    def __str__(self) -> str:
+        """String representation of the slot, e.g. {V_INF verb=<slot 1.verb>}."""
+
+        refs = "".join(f" {feature}={ref}" for feature, ref in self.refs.items())
+
+        return f"{{{self.label}{refs}}}"
+
+
+class Template:
+    """Class for a template: a sequence of terminals and slots, with the probability of its structural choices."""
+
+    def __init__(self, parts: List[str | int], probability: float, spans: List[tuple[str, int, int]], dead_end: Optional[str] = None) -> None:
+        """
+        Initialize the template.
+
+        -   parts (List[str | int]): the terminals of the yield, and the indices of the slots filling the gaps.
+        -   probability (float): the probability of the structural choices leading to this template.
+        -   spans (List[tuple[str, int, int]]): the (label, start, end) range of parts covered by the subtree of each non-terminal.
+        -   dead_end (Optional[str]): if the derivation cannot complete, the message of the DeadEndError raised by the general engine.
+        -   ranges (Dict[str, List[tuple[int, int]]]): the outermost ranges of each label (see label_ranges).
+        """
+
+        self.parts: List[str | int] = parts
+        self.probability: float = probability
+        self.spans: List[tuple[str, int, int]] = spans
+        self.dead_end: Optional[str] = dead_end
+        self.ranges: Dict[str, List[tuple[int, int]]] = {}
+
+    def label_ranges(self, label: str) -> List[tuple[int, int]]:
+        """
+        Return the ranges of parts covered by the subtrees of a label, in order,
+        skipping subtrees nested in another one with the same label (like CFG.generate_yield).
+        """
+
+        if label not in self.ranges:
+            ranges = []
+            for start, end in sorted((start, -end) for span_label, start, end in self.spans if span_label == label):
+                if not ranges or start >= ranges[-1][1]:
+                    ranges.append((start, -end))
+            self.ranges[label] = ranges
+
+        return self.ranges[label]
+
+
+class Program:
+    """Class for a node of the sampling program: steps in derivation order, then a structural choice or a template."""
+
+    def __init__(self) -> None:
+        """
+        Initialize an empty program node.
+
+        -   steps (List[tuple[int, Rule | int]]): the (RULE, rule) and (SLOT, slot index) steps, in derivation order.
+        -   cum_weights (List[float]): the cumulative weights of the structural choice ending the node, if any.
+        -   branches (List[tuple[Rule, Program]]): the rule and the continuation of each alternative of that choice.
+        -   template (Optional[Template]): the template reached at the end of the node, if there is no choice.
+        """
+
+        self.steps: List[tuple[int, Rule | int]] = []
+        self.cum_weights: List[float] = []
+        self.branches: List[tuple[Rule, "Program"]] = []
+        self.template: Optional[Template] = None
+
+
+class TemplateGrammar:
+    """
+    Class for a grammar flattened into templates.
+    The derivations are executed symbolically once: structural choices that do not depend on lexical items are
+    enumerated, and the lexical non-terminals become slots drawn from arrays of lexical rules,
+    tied to earlier slots by their features (e.g., the infinitive and the 3SG form of the same verb).
+    Sampling then only walks the program and indexes into the slot arrays.
+    Rules are referenced by identity rather than by rule ID, so the program survives the ID changes of grammar updates,
+    and updates of lexical non-terminals only patch the slots drawing from them (see update).
+    """
+
+    def __init__(self, grammar: "CFG") -> None:
+        """
+        Flatten the grammar, or raise NotFlattenable if it falls outside the template family.
+        Each step draws from the random generator exactly like the corresponding call to select_rule,
+        so the same random state yields the same examples (and derivations) as grammar.generate_yield.
+
+        -   grammar (CFG): the grammar to flatten.
+        -   lexical (Set[str]): the non-terminals whose rules all rewrite to terminals and have constant features.
+        -   slots (List[Slot]): the lexical slots of all templates.
+        -   dead_labels (Set[str]): the lexical non-terminals of the nodes where no lexical rule applies (dead-end templates).
+        -   templates (List[Template]): the templates, one per sequence of structural choices.
+        -   root (Program): the sampling program.
+        """
+
+        self.grammar: "CFG" = grammar
+        self.lexical = set(label for label in grammar.mappings if self.is_lexical(label))
+        self.slots: List[Slot] = []
+        self.dead_labels: Set[str] = set()
+        self.templates: List[Template] = []
+
+        stack: List[tuple[Any, Any, Any]] = [(grammar.axiom, {}, None)]
+        self.root: Program = self.explore(stack, {}, [], [], 1.0, 0)
+
+    def is_lexical(self, label: str) -> bool:
+        """Check if all the rules of a non-terminal rewrite to terminals and have constant features."""
+
+        rules = self.grammar.mappings.get(label)
+
+        return bool(rules) and all(self.is_lexical_rule(rule) for rule in rules)
+
+    def is_lexical_rule(self, rule: Rule) -> bool:
+        """Check if a rule rewrites to terminals and has constant features."""
+
+        grammar = self.grammar
+
+        return bool(rule.right) and all(grammar.is_terminal(symbol) for symbol in rule.right) and not any(
+            grammar.is_variable(value) for value in rule.features.values()
+        )
+
+    def explore(
+        self,
+        stack: List[tuple[Any, Any, Any]],
+        bindings: Dict[str, Dict[str, Any]],
+        parts: List[str | int],
+        spans: List[tuple[str, int, int]],
+        probability: float,
+        expansions: int
+    ) -> Program:
+        """
+        Symbolically execute the derivation from a given state, mirroring CFG.generate_yield,
+        and return the program node for it. Structural choices fork the state.
+
+        -   stack (List[tuple]): the (symbol, features, parent_label) stack of the derivation,
+            with (None, label, start) items marking the end of the subtree of a structural non-terminal.
+        -   bindings (Dict): the feature bindings of the derivation, which may hold SlotValue references.
+        -   parts (List[str | int]): the yield so far.
+        -   spans (List[tuple[str, int, int]]): the (label, start, end) ranges of parts covered by the completed subtrees.
+        -   probability (float): the probability of the structural choices so far.
+        -   expansions (int): the number of expansions so far.
+        """
+
+        grammar = self.grammar
+        program = Program()
+
+        while stack:
+            item = stack.pop()
+
+            # End of the subtree of a structural non-terminal: record the range of the yield it covers
+            if item[0] is None:
+                spans.append((item[1], item[2], len(parts)))
+                continue
+
+            label, features, parent_label = item
+
+            # Terminal symbols go straight to the yield
+            if grammar.is_terminal(label):
+                parts.append(label)
+                continue
+
+            expansions += 1
+            if expansions > MAX_EXPANSIONS:
+                raise NotFlattenable(f"More than {MAX_EXPANSIONS} expansions in a derivation")
+
+            # Unknown symbols are left to the general engine, which reports them
+            if not grammar.is_non_terminal(label):
+                raise NotFlattenable(f"Unknown symbol: {label}")
+
+            context = {**features, **bindings.get(label, {})}
+
+            # Lexical non-terminals become slots
+            if label in self.lexical:
+                slot = self.add_slot(label, features, context, parent_label, bindings)
+
+                if slot is None:
+                    self.dead_labels.add(label)
+                    return self.finish(program, parts, spans, probability, f"No applicable rules for {label} with features {features}")
+
+                program.steps.append((SLOT, slot.index))
+                spans.append((label, len(parts), len(parts) + 1))
+                parts.append(slot.index)
+                continue
+
+            # Structural non-terminals: the candidates only depend on the state of the derivation
+            candidates = []
+            weights = []
+            for rule, weight in zip(grammar.mappings[label], grammar.weights[label]):
+                merged_features = self.unify(context, rule.features)
+
+                if merged_features is not None:
+                    candidates.append((rule, merged_features))
+                    weights.append(weight)
+
+            if not candidates:
+                return self.finish(program, parts, spans, probability, f"No applicable rules for {label} with features {features}")
+
+            # The general engine draws even when there is a single candidate
+            if len(candidates) == 1:
+                rule, merged_features = candidates[0]
+                program.steps.append((RULE, rule))
+                self.apply(rule, merged_features, label, features, parent_label, stack, bindings, parts)
+                continue
+
+            # Several candidates: fork the derivation for each of them
+            program.cum_weights = list(accumulate(weights))
+            total = program.cum_weights[-1]
+
+            if total <= 0.0:
+                raise NotFlattenable(f"Rules for {label} have a total weight of {total}")
+
+            for (rule, merged_features), weight in zip(candidates, weights):
+                branch_stack = list(stack)
+                branch_bindings = {non_terminal: dict(values) for non_terminal, values in bindings.items()}
+                branch_parts = list(parts)
+                self.apply(rule, merged_features, label, features, parent_label, branch_stack, branch_bindings, branch_parts)
+
+                branch = self.explore(branch_stack, branch_bindings, branch_parts, list(spans), probability * weight / total, expansions)
+                program.branches.append((rule, branch))
+
+            return program
+
+        return self.finish(program, parts, spans, probability)
+
+    def finish(
+        self,
+        program: Program,
+        parts: List[str | int],
+        spans: List[tuple[str, int, int]],
+        probability: float,
+        dead_end: Optional[str] = None
+    ) -> Program:
+        """End a program node with a template."""
+
+        if len(self.templates) >= MAX_TEMPLATES:
+            raise NotFlattenable(f"More than {MAX_TEMPLATES} templates")
+
+        program.template = Template(parts, probability, spans, dead_end)
+        self.templates.append(program.template)
+
+        return program
+
+    def unify(self, context: Dict[str, Any], rule_features: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Symbolic counterpart of cfg_utils.unify for structural rules.
+        Raises NotFlattenable when the outcome depends on a value bound by a slot.
+        """
+
+        merged: Dict[str, Any] = {}
+        undecided = False
+
+        for key in set(context) | set(rule_features):
+            v_node = context.get(key)
+            v_rule = rule_features.get(key)
+
+            if v_node is None:
+                merged[key] = v_rule
+            elif v_rule is None:
+                merged[key] = v_node
+            elif v_node == v_rule:
+                merged[key] = v_node
+            elif self.grammar.is_variable(v_node) and self.grammar.is_variable(v_rule):
+                raise NotFlattenable(f"Inconsistent variable values for feature '{key}': {v_node} vs {v_rule}")
+            elif self.grammar.is_variable(v_rule):
+                merged[key] = v_node
+            elif self.grammar.is_variable(v_node):
+                merged[key] = v_rule
+            elif isinstance(v_node, SlotValue) or isinstance(v_rule, SlotValue):
+                undecided = True
+            else:
+                return None
+
+        # A conflict on a constant decides regardless of the slots
+        if undecided:
+            raise NotFlattenable("Structural choice depending on a lexical item")
+
+        return merged
+
+    def apply(
+        self,
+        rule: Rule,
+        merged_features: Dict[str, Any],
+        label: str,
+        features: Dict[str, Any],
+        parent_label: Optional[str],
+        stack: List[tuple[Any, Any, Any]],
+        bindings: Dict[str, Dict[str, Any]],
+        parts: List[str | int]
+    ) -> None:
+        """Apply a structural rule to the state of the derivation, like select_rule and generate_yield do."""
+
+        # Record any variable binding in the parent non-terminal
+        if parent_label is not None and self.grammar.is_non_terminal(parent_label):
+            for feature, value in merged_features.items():
+                if self.grammar.is_variable(features.get(feature)) or self.grammar.is_variable(rule.features.get(feature)):
+                    bindings.setdefault(parent_label, {})[feature] = value
+
+        # Mark the end of the subtree, which starts here
+        stack.append((None, label, len(parts)))
+
+        # A node expanded with an empty rule is a leaf of the tree
+        if not rule.right:
+            parts.append(label)
+
+        for symbol in reversed(rule.right):
+            stack.append((symbol, merged_features, label))
+
+    def add_slot(
+        self,
+        label: str,
+        features: Dict[str, Any],
+        context: Dict[str, Any],
+        parent_label: Optional[str],
+        bindings: Dict[str, Dict[str, Any]]
+    ) -> Optional[Slot]:
+        """
+        Create the slot of a lexical node and record the bindings it produces.
+        Returns None if no lexical rule can ever apply to it.
+        """
+
+        grammar = self.grammar
+        refs = {feature: value for feature, value in context.items() if isinstance(value, SlotValue)}
+        constants = {feature: value for feature, value in context.items() if not isinstance(value, SlotValue)}
+
+        # Keep the lexical rules compatible with the constant features, in grammar order
+        compatible = self.compatible(label, constants)
+
+        if not compatible:
+            return None
+
+        slot = Slot(len(self.slots), label, [rule for rule, _ in compatible], [weight for _, weight in compatible], refs, constants)
+        self.slots.append(slot)
+
+        # Variables of the node are bound to the features of the selected lexical rule
+        if parent_label is not None and grammar.is_non_terminal(parent_label):
+            for feature, value in features.items():
+                if not grammar.is_variable(value):
+                    continue
+
+                if grammar.is_variable(context[feature]):
+                    if not all(feature in rule.features for rule in slot.rules):
+                        raise NotFlattenable(f"Feature '{feature}' is not defined by all {label} rules")
+                    slot.required.add(feature)
+                    bindings.setdefault(parent_label, {})[feature] = SlotValue(slot.index, feature)
+                else:
+                    bindings.setdefault(parent_label, {})[feature] = context[feature]
+
+        return slot
+
+    def compatible(self, label: str, constants: Dict[str, Any]) -> List[tuple[Rule, float]]:
+        """Return the lexical rules of a non-terminal compatible with constant features, and their weights, in grammar order."""
+
+        grammar = self.grammar
+        candidates = zip(grammar.mappings[label], grammar.weights[label])
+
+        if not constants:
+            return list(candidates)
+
+        return [(rule, weight) for rule, weight in candidates if unify(constants, rule.features) is not None]
+
+    def update(self, labels: Set[str], added: Sequence[Rule] = ()) -> bool:
+        """
+        Patch the flattened grammar after the rules of some non-terminals were added or removed (see CFG.invalidate):
+        only the slots drawing from these non-terminals get their rules and weights again, the program is left as is,
+        so an update costs time proportional to the rules of the updated non-terminals.
+        Returns False, without patching anything, if the update changes the structure of the templates (a structural
+        non-terminal, a non-terminal losing all its rules, a non-lexical rule, a slot losing all its rules or a dead end
+        gaining one, or a new rule lacking a feature bound by later slots); the grammar must then be flattened again.
+
+        -   labels (Set[str]): the updated non-terminals.
+        -   added (Sequence[Rule]): the added rules (the rules already flattened are known to be lexical).
+        """
+
+        grammar = self.grammar
+
+        if not labels <= self.lexical or labels & self.dead_labels:
+            return False
+
+        if not all(label in grammar.mappings for label in labels) or not all(self.is_lexical_rule(rule) for rule in added):
+            return False
+
+        patched = []
+        for slot in self.slots:
+            if slot.label not in labels:
+                continue
+
+            rules = grammar.mappings[slot.label]
+            weights = grammar.weights[slot.label]
+            new_rules = [rule for rule in added if rule.left == slot.label]
+            compatible = [rule for rule in new_rules if unify(slot.constants, rule.features) is not None]
+
+            # Only the new rules may lack a feature bound by later slots
+            if not all(feature in rule.features for rule in compatible for feature in slot.required):
+                return False
+
+            # Added rules follow the rules of the slot in grammar order: only they are indexed
+            if added:
+                if len(slot.rules) == len(rules) - len(new_rules) and len(compatible) == len(new_rules):
+                    slot_weights = list(weights)
+                else:
+                    slot_weights = [grammar.probs[grammar.rule_ids[id(rule)]] for rule in slot.rules + compatible]
+                patched.append((slot, compatible, slot_weights, True))
+                continue
+
+            # Removed rules: the slot keeps its remaining rules
+            kept = set(map(id, slot.rules))
+            remaining = [(rule, weight) for rule, weight in zip(rules, weights) if id(rule) in kept]
+            if not remaining:
+                return False
+
+            patched.append((slot, [rule for rule, _ in remaining], [weight for _, weight in remaining], False))
+
+        for slot, rules, weights, append in patched:
+            if append:
+                slot.add_rules(rules, weights)
+            else:
+                slot.set_rules(rules, weights)
+
+        return True
+
+    @profiler.timed("templates.generate_yield")
+    def generate_yield(
+        self,
+        derivation: bool = False,
+        rng: Optional[random.Random] = None,
+        spans: Optional[Sequence[str]] = None
+    ) -> List[str] | Dict[str, List[str]] | tuple[List[str] | Dict[str, List[str]], List[int]]:
+        """
+        Generate the terminal yield of a derivation by walking the program.
+        Same interface (and, for the same random state, same output) as CFG.generate_yield.
+
+        -   derivation (bool): if True, also return the sequence of applied rule IDs.
+        -   rng (Optional[random.Random]): the random generator (the global random module by default).
+        -   spans (Optional[Sequence[str]]): if given, return the yields of the subtrees of these non-terminals.
+        """
+
+        draw = (rng if rng is not None else random).random
+        chosen: List[Optional[Rule]] = [None] * len(self.slots)
+        rules: List[Rule] = []
+        program = self.root
+
+        while True:
+            for kind, value in program.steps:
+                if kind == RULE:
+                    draw()
+                    rules.append(value)
+                    continue
+
+                # Like select_rule, a dead end is detected before drawing
+                slot = self.slots[value]
+                positions, cum_weights = slot.lookup(chosen)
+                if not positions:
+                    raise DeadEndError(f"No applicable rules for {slot.label} with features {slot.refs}")
+
+                position = positions[bisect(cum_weights, draw() * cum_weights[-1], 0, len(positions) - 1)]
+                chosen[value] = slot.rules[position]
+                rules.append(chosen[value])
+
+            if program.template is not None:
+                break
+
+            # Structural choice
+            u = draw()
+            cum_weights = program.cum_weights
+            rule, program = program.branches[bisect(cum_weights, u * cum_weights[-1], 0, len(cum_weights) - 1)]
+            rules.append(rule)
+
+        template = program.template
+        if template.dead_end is not None:
+            raise DeadEndError(template.dead_end)
+
+        if spans is None:
+            result = self.fill(template.parts, chosen)
+        else:
+            result = {}
+            for label in spans:
+                result[label] = []
+                for start, end in template.label_ranges(label):
+                    result[label].extend(self.fill(template.parts[start:end], chosen))
+
+        if derivation:
+            return result, [self.grammar.rule_ids[id(rule)] for rule in rules]
+
+        return result
+
+    def fill(self, parts: List[str | int], chosen: List[Optional[Rule]]) -> List[str]:
+        """Return the tokens of template parts, with the slots filled by the chosen lexical rules."""
+
+        tokens: List[str] = []
+        for part in parts:
+            if isinstance(part, int):
+                tokens.extend(chosen[part].right)
+            else:
+                tokens.append(part)
+
+        return tokens
+
+    def __str__(self) -> str:
+        """String representation of the templates and their probabilities."""
+
+        lines = []
+        for template in self.templates:
+            text = " ".join(str(self.slots[part]) if isinstance(part, int) else part for part in template.parts)
+            status = " [dead end]" if template.dead_end else ""
+            lines.append(f"{template.probability:.3f}  {text}{status}")
+
+        return "\n".join(lines)
+
+
+def flatten(grammar: "CFG") -> Optional[TemplateGrammar]:
+    """Flatten a grammar into templates, or return None if it must be sampled by the general engine."""
+
+    try:
+        return TemplateGrammar(grammar)
+    except NotFlattenable:
+        return None
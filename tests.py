@@ -1 +1,411 @@
 # Testing file
+
+import json
+import random
+import sqlite3
+import asyncio
+import pytest
+import torch
+import numpy as np
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from source import generate
+from source.cache import ResponseCache
+from source.evaluate import CANONICAL_LABELS, evaluate, label_order
+from source.cfg import CFG
+from source.lexicon import LexiconStore
+from source.cfg_utils import Rule, Detokenizer, DeadEndError, join
+from grammars.free_choice import fcp_base, build_lexicon, populate
+from benchmarks.common import synthetic_lexicon
+
+SEEDS = range(50)
+SPANS = ("<PREMISE>", "<HYPOTHESIS>")
+
+
+def fcp_grammars(size=5):
+    """Build the free-choice grammars with a synthetic lexicon of `size` items per category."""
+
+    populated = populate(fcp_base, build_lexicon(synthetic_lexicon(size)))
+
+    return {name: CFG(rules=rules, axiom="S", name=name) for name, rules in populated.items()}
+
+
+def test_detokenizer_matches_join():
+    """Detokenizer.join produces the same sentences as join, for grammar yields and for arbitrary token sequences."""
+
+    for grammar in fcp_grammars().values():
+        for seed in SEEDS:
+            tokens = grammar.generate_yield(rng=random.Random(seed))
+            assert grammar.detokenizer.join(tokens) == join(tokens)
+
+    # Tokens outside the precomputed vocabulary are added on the fly
+    vocabulary = ["", ".", "?", "!", ",", ":", " ", "]", "[P]", "a", "b.", "c?", "élan", "1", " x", "y:"]
+    rng = random.Random(0)
+    for detokenizer in (Detokenizer(), Detokenizer(vocabulary[:8])):
+        for _ in range(2000):
+            tokens = [rng.choice(vocabulary) for _ in range(rng.randint(0, 8))]
+            assert detokenizer.join(tokens) == join(tokens), tokens
+
+
+def test_chunked_lexicon_generation_deduplicates_and_retries(monkeypatch):
+    """Lexicon generation drops duplicate items across chunks, requests rejected or unproductive chunks again, and gives up after max_retries failures."""
+
+    prompts = {
+        "verbs": {"labels": ["V_INF", "V_3SG"], "prompt": ["Give {k} verbs."], "linked": True},
+        "nouns": {"labels": ["N", "ADJ"], "prompt": ["Give {k} nouns and adjectives."]},
+    }
+    responses = {
+        "V_INF": [
+            {"V_INF": ["run", "swim"], "V_3SG": ["runs", "swims"]},
+            ValueError("Output format was not validated"),
+            {"V_INF": ["Run", "dance"], "V_3SG": ["Runs", "dances"]},
+            {"V_INF": ["sing", "swim "], "V_3SG": ["sings", "swims"]},
+        ],
+        "N": [
+            {"N": ["cat", "dog"], "ADJ": ["red", "red"]},
+            {"N": ["cat", "Dog"], "ADJ": ["blue", "green"]},
+            {"N": ["bird", "cow"], "ADJ": ["RED", "pink"]},
+        ],
+    }
+    requests = []
+
+    async def fake_agenerate_items(client, prompt, k, field_names, *args):
+        requests.append((field_names[0], k))
+        response = responses[field_names[0]].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return {name: items[:k] for name, items in response.items()}
+
+    monkeypatch.setattr(generate, "agenerate_items", fake_agenerate_items)
+    items = generate.generate_lexicon(prompts, 4, chunk_size=2)
+
+    # Linked forms are deduplicated as entries, independent fields one by one
+    assert items["V_INF"] == ["run", "swim", "dance", "sing"] and items["V_3SG"] == ["runs", "swims", "dances", "sings"]
+    assert items["N"] == ["cat", "dog", "bird", "cow"] and items["ADJ"] == ["red", "blue", "green", "pink"]
+
+    # Only the missing items are requested again
+    assert sorted(requests) == [("N", 2)] * 3 + [("V_INF", 1)] + [("V_INF", 2)] * 3
+
+    # A prompt whose chunks keep failing gives up
+    responses["V_INF"] = [ValueError("No content in model response")] * 3
+    with pytest.raises(ValueError, match="gave up"):
+        generate.generate_lexicon({"verbs": prompts["verbs"]}, 2, max_retries=2)
+
+
+def test_response_cache_serves_repeated_requests(tmp_path):
+    """A validated response is cached under (model, prompt, schema, seed, ordinal): repeated requests are served without calling the model."""
+
+    class FakeClient:
+        def __init__(self):
+            self.calls = 0
+
+        async def chat(self, **kwargs):
+            self.calls += 1
+            return {"message": {"content": json.dumps({"N": [f"cat{self.calls}", f"dog{self.calls}"]})}}
+
+    client, cache = FakeClient(), ResponseCache(tmp_path)
+
+    def request(ordinal=0, model="mistral", seed=1):
+        return asyncio.run(generate.agenerate_items(client, "Give 2 nouns.", 2, ["N"], model, seed, cache, ordinal))
+
+    first = request()
+    assert request() == first and client.calls == 1
+
+    # Another chunk, model or seed is a miss
+    assert request(ordinal=1) != first and request(model="llama3") != first and request(seed=2) != first
+    assert client.calls == 4
+
+    # Invalid outputs are not cached
+    client.chat = lambda **kwargs: asyncio.sleep(0, {"message": {"content": '{"N": ["cat"]}'}})
+    with pytest.raises(ValueError):
+        request(ordinal=2)
+    assert len(list(tmp_path.glob("*.json"))) == 4
+
+
+def test_label_order_realigns_model_columns():
+    """Models with a different id2label order give the same canonical probabilities; unknown labels keep the model order."""
+
+    pairs = [("The boy sleeps.", f"The boy sleeps {i}.") for i in range(5)]
+    canonical = torch.softmax(torch.randn(len(pairs), 3, generator=torch.Generator().manual_seed(0)), dim=1)
+
+    class FakeModel:
+        def __init__(self, id2label):
+            self.config = SimpleNamespace(id2label=id2label)
+            self.columns = [CANONICAL_LABELS.index(id2label[i].lower()) for i in range(3)]
+
+        def __call__(self, rows):
+            return SimpleNamespace(logits=canonical[rows][:, self.columns].log())
+
+    def tokenizer(premises, hypotheses, **kwargs):
+        return {"rows": torch.tensor([pairs.index(pair) for pair in zip(premises, hypotheses)])}
+
+    for id2label in ({0: "entailment", 1: "neutral", 2: "contradiction"}, {0: "CONTRADICTION", 1: "ENTAILMENT", 2: "NEUTRAL"}, {0: "Neutral", 1: "Contradiction", 2: "Entailment"}):
+        results, classes = evaluate(pairs, "fake", batch_size=2, loaded=(tokenizer, FakeModel(id2label)))
+        assert classes == CANONICAL_LABELS
+        assert np.allclose(results.probs, canonical.numpy(), atol=1e-6)
+        assert results.labels() == [CANONICAL_LABELS[i] for i in canonical.argmax(dim=1)]
+
+    assert label_order({0: "LABEL_0", 1: "LABEL_1", 2: "LABEL_2"}) == ([0, 1, 2], ["label_0", "label_1", "label_2"])
+
+
+def test_threads_sharing_a_grammar_match_a_sequential_run():
+    """Threads sampling from the same CFG (general and template engines) draw the same examples as a sequential run."""
+
+    indices = range(200)
+
+    for grammar in fcp_grammars().values():
+        sequential = [grammar.generate_yield(True, rng=random.Random(i)) for i in indices]
+        examples = generate.generate_examples(grammar, len(indices), seed=3, use_templates=False)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            assert list(pool.map(lambda i: grammar.generate_yield(True, rng=random.Random(i)), indices)) == sequential
+            assert list(pool.map(lambda i: grammar.generate(rng=random.Random(i)).output(), indices)) == [tokens for tokens, _ in sequential]
+
+            # Shards of examples generated concurrently, with both engines
+            for use_templates in (False, True):
+                shards = pool.map(lambda start: generate.generate_examples(grammar, start=start, stop=start + 50, seed=3, use_templates=use_templates), range(0, len(indices), 50))
+                assert [example for shard in shards for example in shard] == examples
+
+
+def test_sharded_generation_matches_one_run():
+    """Examples generated in index shards with a seed are the examples of one unsharded run, in any shard order."""
+
+    for grammar in fcp_grammars().values():
+        for use_templates in (False, True):
+            examples = generate.generate_examples(grammar, 120, seed=7, use_templates=use_templates)
+            shards = [(60, 120), (0, 25), (25, 60)]
+            sharded = {start: generate.generate_examples(grammar, start=start, stop=stop, seed=7, use_templates=use_templates) for start, stop in shards}
+            assert [example for start in sorted(sharded) for example in sharded[start]] == examples
+
+            # Single examples are computed directly from (seed, index), and another seed draws other examples
+            assert generate.generate_examples(grammar, 1, start=97, seed=7, use_templates=use_templates) == examples[97:98]
+            assert generate.generate_examples(grammar, 120, seed=8, use_templates=use_templates) != examples
+
+        pairs = list(generate.generate_pairs(grammar, 120, seed=7))
+        assert list(generate.generate_pairs(grammar, start=40, stop=120, seed=7)) == pairs[40:]
+
+
+def dead_end_grammar(unproductive=True):
+    """
+    Small grammar with dead rules (unproductive, unsatisfiable and unreachable), where a derivation
+    reaches a dead end when the feature bound under the first X does not allow the W of the second.
+    """
+
+    rules = [
+        Rule("S", ["X", "X"]),
+        Rule("S", ["A"], features={"g": "a"}),
+        Rule("X", ["Y"], features={"f": "?v"}),
+        Rule("X", ["W"], features={"f": "?v"}),
+        Rule("Y", ["y1"], features={"f": "1"}),
+        Rule("Y", ["y2"], features={"f": "2"}),
+        Rule("W", ["w"], features={"f": "2"}),
+        Rule("A", ["a"], features={"g": "a"}),
+        Rule("A", ["b"], features={"g": "b"}),
+        Rule("Z", ["z"]),
+    ]
+    if unproductive:
+        rules += [Rule("S", ["U"]), Rule("U", ["U", "u"])]
+
+    return CFG(rules=rules, axiom="S", name="dead_ends")
+
+
+def test_analyze_and_prune_dead_rules():
+    """analyze reports the unproductive, unsatisfiable and unreachable rules, and prune removes exactly them."""
+
+    grammar = dead_end_grammar()
+    analysis = grammar.analyze()
+
+    reasons = {grammar.rule_string(rule_id).split(" [")[0]: reason for rule_id, reason in analysis.dead_rules.items()}
+    assert reasons == {"S -> U": "unproductive", "U -> U u": "unproductive", "A -> b": "unsatisfiable", "Z -> z": "unreachable"}
+    assert analysis.unproductive == {"U"} and analysis.unreachable == {"Z"}
+    assert len(analysis.to_dict()["dead_rules"]) == 4
+
+    pruned = grammar.prune(analysis)
+    assert [rule for rule in grammar.rules if rule not in pruned.rules] == [grammar.rules[rule_id] for rule_id in sorted(analysis.dead_rules)]
+    assert not pruned.analyze().dead_rules
+
+    # Without unproductive rules, the dead rules are never candidates: the pruned grammar draws the same examples
+    grammar = dead_end_grammar(unproductive=False)
+    examples = generate.generate_examples(grammar, 100, seed=0)
+    assert generate.generate_examples(grammar.prune(), 100, seed=0) == examples
+
+
+def test_dead_ends_are_retried_up_to_max_retries():
+    """Dead ends restart the derivation of the example (reproducibly with a seed), until max_retries is exhausted."""
+
+    grammar = dead_end_grammar(unproductive=False)
+
+    for use_templates in (False, True):
+        examples = generate.generate_examples(grammar, 100, seed=0, use_templates=use_templates)
+        assert generate.generate_examples(grammar, 100, seed=0, use_templates=use_templates) == examples
+
+        # Without retries, some examples fail, and the others are unchanged
+        failed = 0
+        for index in range(100):
+            try:
+                assert generate.generate_examples(grammar, 1, start=index, seed=0, use_templates=use_templates, max_retries=0) == examples[index:index + 1]
+            except DeadEndError:
+                failed += 1
+        assert 0 < failed < 100
+
+        with pytest.raises(DeadEndError):
+            generate.generate_examples(grammar, 100, seed=0, use_templates=use_templates, max_retries=0)
+
+
+def test_generate_pairs_joins_the_premise_and_hypothesis_subtrees():
+    """generate_pairs returns the sentences of the <PREMISE> and <HYPOTHESIS> subtrees, even when they contain marker-like tokens."""
+
+    for grammar in fcp_grammars().values():
+        examples = generate.generate_examples(grammar, 50, seed=5)
+        for use_templates in (False, True):
+            pairs = list(generate.generate_pairs(grammar, 50, seed=5, use_templates=use_templates))
+            assert [f"[P] {premise} [H] {hypothesis}" for premise, hypothesis in pairs] == examples
+
+    # Nothing is split on markers: "[H]" inside the premise stays in the premise
+    grammar = CFG(rules=[
+        Rule("S", ["<PREMISE>", "<HYPOTHESIS>"]),
+        Rule("<PREMISE>", ["the", "[H]", "tag", "."]),
+        Rule("<HYPOTHESIS>", ["a", "tag", "."]),
+    ], axiom="S", name="markers")
+    assert list(generate.generate_pairs(grammar, 2, seed=0)) == [("The [H] Tag.", "A tag.")] * 2
+
+    with pytest.raises(ValueError, match="<HYPOTHESIS>"):
+        next(generate.generate_pairs(CFG(rules=[Rule("S", ["<PREMISE>"]), Rule("<PREMISE>", ["a"])], axiom="S")))
+
+
+def test_templates_match_generate_yield():
+    """The template engine draws the same examples as CFG.generate_yield, with and without spans and derivations."""
+
+    flattened = 0
+
+    for name, grammar in fcp_grammars().items():
+        engine = grammar.template_engine()
+        if engine is None:
+            continue
+        flattened += 1
+
+        for seed in SEEDS:
+            for spans in (None, SPANS):
+                for derivation in (False, True):
+                    expected = grammar.generate_yield(derivation, rng=random.Random(seed), spans=spans)
+                    assert engine.generate_yield(derivation, rng=random.Random(seed), spans=spans) == expected, (name, seed, spans, derivation)
+
+    assert flattened
+
+
+def test_coverage_quotas_are_met():
+    """Coverage-targeted sampling uses every candidate rule min_uses times first, then samples by probability again."""
+
+    rules = [Rule("S", ["N", "V"])]
+    rules += [Rule("N", [f"n{i}"], prob=10 if i == 0 else 1) for i in range(10)]
+    rules += [Rule("V", [f"v{i}"]) for i in range(5)]
+    nouns, verbs = range(1, 11), range(11, 16)
+
+    # Balanced until the quota is reached, despite the skewed probabilities
+    grammar = CFG(rules=rules, axiom="S", name="quotas")
+    coverage = grammar.enable_coverage(min_uses=2)
+    generate.generate_examples(grammar, 20, seed=0)
+    assert [coverage.uses[rule_id] for rule_id in nouns] == [2] * 10
+    assert min(coverage.uses[rule_id] for rule_id in verbs) >= 2
+    assert coverage.to_dict(grammar)["unused"] == []
+
+    generate.generate_examples(grammar, 100, start=20, seed=0)
+    assert coverage.uses[nouns[0]] > 3 * max(coverage.uses[rule_id] for rule_id in nouns[1:])
+
+    # Without min_uses, choices stay balanced
+    coverage = grammar.enable_coverage()
+    generate.generate_examples(grammar, 30, seed=0)
+    assert [coverage.uses[rule_id] for rule_id in nouns] == [3] * 10 and [coverage.uses[rule_id] for rule_id in verbs] == [6] * 5
+
+    # Every live rule of the free-choice grammars is covered with a few examples per lexical item
+    for grammar in fcp_grammars(10).values():
+        grammar = grammar.prune()
+        coverage = grammar.enable_coverage(min_uses=1)
+        generate.generate_examples(grammar, 40, seed=0)
+        assert coverage.to_dict(grammar)["least_uses"] >= 1, grammar.name
+
+
+def test_incremental_updates_match_rebuild():
+    """add_rules and remove_rules leave a grammar (and its patched template engine) sampling like the same grammar rebuilt from scratch."""
+
+    for name, grammar in fcp_grammars().items():
+        rules = list(grammar.rules)
+        lexical = [rule for rule in rules if rule.left == "NP"]
+        flattened = grammar.template_engine() is not None
+
+        # Add new lexical items: same derivations as the rebuilt grammar (new rules get the next IDs)
+        new_rules = [Rule(left="NP", right=[f"the newcomer{i}"], features={"subj": f"the newcomer{i}"}) for i in range(3)]
+        assert grammar.add_rules(new_rules + lexical[:1]) == new_rules
+        rebuilt = CFG(rules=rules + new_rules, axiom="S", name=name)
+        engine = grammar.template_engine()
+
+        # Lexical updates patch the template engine instead of dropping it
+        assert (engine is not None) == flattened and grammar.templates_compiled
+
+        for seed in SEEDS:
+            expected = rebuilt.generate_yield(True, rng=random.Random(seed))
+            assert grammar.generate_yield(True, rng=random.Random(seed)) == expected
+            if engine is not None:
+                assert engine.generate_yield(True, rng=random.Random(seed)) == expected
+
+        # Remove some of them again: same yields as the rebuilt grammar (rule IDs are reassigned)
+        removed = lexical[:2] + new_rules[:1]
+        assert set(grammar.remove_rules(removed)) == set(removed)
+        rebuilt = CFG(rules=[rule for rule in rules + new_rules if rule not in removed], axiom="S", name=name)
+        engine = grammar.template_engine()
+
+        for seed in SEEDS:
+            expected = rebuilt.generate_yield(rng=random.Random(seed), spans=SPANS)
+            assert grammar.generate_yield(rng=random.Random(seed), spans=SPANS) == expected
+            if engine is not None:
+                assert engine.generate_yield(True, rng=random.Random(seed), spans=SPANS) == grammar.generate_yield(True, rng=random.Random(seed), spans=SPANS)
+
+        assert grammar.probs == [rebuilt.probs[rebuilt.rule_ids[id(rule)]] for rule in grammar.rules]
+
+        # Structural updates drop the template engine, which is recompiled from the updated grammar on next use
+        structural = Rule(left="S", right=["[P]", "<HYPOTHESIS>", "[H]", "<PREMISE>"])
+        assert grammar.add_rules([structural]) == [structural]
+        assert not grammar.templates_compiled
+        rebuilt = CFG(rules=[rule for rule in rules + new_rules if rule not in removed] + [structural], axiom="S", name=name)
+        engine = grammar.template_engine()
+
+        for seed in SEEDS:
+            expected = rebuilt.generate_yield(rng=random.Random(seed), spans=SPANS)
+            assert grammar.generate_yield(rng=random.Random(seed), spans=SPANS) == expected
+            if engine is not None:
+                assert engine.generate_yield(True, rng=random.Random(seed), spans=SPANS) == grammar.generate_yield(True, rng=random.Random(seed), spans=SPANS)
+
+
+def test_lexicon_store_deduplicates_imports_and_opens_readonly(tmp_path):
+    """The lexicon store skips duplicate entries across batches, imports the JSON rule files and can be opened read-only."""
+
+    prompts = {
+        "Verbs": {"labels": ["V_INF", "V_3SG"], "linked": True},
+        "Nouns": {"labels": ["N", "ADJ"]},
+    }
+
+    with pytest.raises(FileNotFoundError):
+        LexiconStore(tmp_path / "lexicon.db", readonly=True)
+
+    store = LexiconStore(tmp_path / "lexicon.db")
+    assert store.add("Verbs", {"V_INF": ["run", "swim"], "V_3SG": ["runs", "swims"]}, linked=True) == 2
+    assert store.add("Verbs", {"V_INF": ["Run ", "dance"], "V_3SG": ["Runs", "dances"]}, linked=True) == 1
+    assert store.add("Nouns", {"N": ["cat", "red"], "ADJ": ["red"]}) == 3
+
+    # The JSON rule files are merged into the store with the same deduplication
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"V_INF": ["swim", "sing"], "V_3SG": ["swims", "sings"], "N": ["cat", "dog"], "DET": ["the"]}))
+    assert store.import_json(path, prompts) == 3
+
+    expected = {"V_INF": ["run", "swim", "dance", "sing"], "V_3SG": ["runs", "swims", "dances", "sings"], "N": ["cat", "red", "dog"], "ADJ": ["red"], "DET": ["the"]}
+    assert store.items() == expected
+    assert store.entries("Verbs")[2] == {"V_INF": "dance", "V_3SG": "dances"}
+    assert len(store) == 9
+    store.close()
+
+    # A read-only store serves the same items and refuses writes
+    store = LexiconStore(tmp_path / "lexicon.db", readonly=True)
+    assert store.items() == expected
+    with pytest.raises(sqlite3.OperationalError):
+        store.add("Nouns", {"N": ["bird"]})
+    store.close()